@@ -0,0 +1,187 @@
+#! /usr/local/bin/python3
+"""Behaviour checks of the pi-hole plugin modules against local stand-ins.
+
+usage: check_pihole.py [--timeout 2] [--slow 0.5]
+
+Instances served by fake_pihole.py, one of them slow and one failing,
+are polled the way the plugin does (collect() over summary_task), and
+the aggregate, the slow marking and the unreachable instance are
+checked. Over a few refreshes with one instance down, the per-instance
+histories must keep sampling and mark the gap. DnsReconciler is driven
+with a recording setter: it must not be called while the resolved and
+system server sets agree, and exactly once when they differ. The exit
+status is 1 when a check fails.
+"""
+import argparse
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fake_pihole import FakePihole
+
+# state files go to a scratch directory, set before xbar_state is imported
+os.environ["XBAR_CACHE_DIR"] = tempfile.mkdtemp(prefix="check-pihole-")
+atexit.register(shutil.rmtree, os.environ["XBAR_CACHE_DIR"], ignore_errors=True)
+sys.path.insert(0, (Path(__file__).parent.parent / "scripts").as_posix())
+from pihole_api import SUMMED, Instance, aggregate, make_session, summary_task
+from pihole_collect import collect
+from pihole_dns import DnsReconciler
+from pihole_history import History, merged_deltas, sample_values
+
+results = []
+
+
+def number(value):
+    # summaries carry counters as "1,234" strings
+    return float(str(value).replace(",", ""))
+
+
+def check(name, ok, detail=""):
+    results.append(ok)
+    print(f"{'OK' if ok else 'FAILED':6} {name}" + (f": {detail}" if detail else ""))
+
+
+def check_instances(timeout, slow):
+    servers = [
+        FakePihole().start(),
+        FakePihole(rate=50).start(),
+        FakePihole(delay=slow * 2).start(),
+        FakePihole(fail=True).start(),
+    ]
+    fast, other, slowest, failing = servers
+    urls = [server.base_url for server in servers]
+    session = make_session(len(urls))
+    started = time.monotonic()
+    polled = collect(
+        {url: (summary_task(session, url, timeout), timeout) for url in urls}
+    )
+    elapsed = time.monotonic() - started
+    instances = [Instance.from_result(url, polled[url]) for url in urls]
+    by_url = {instance.url: instance for instance in instances}
+
+    check(
+        "instances are polled in parallel",
+        elapsed < slowest.delay + slow,
+        f"{elapsed:.2f}s for a slowest instance of {slowest.delay:.2f}s",
+    )
+    check(
+        "failing instance is unreachable",
+        not by_url[failing.base_url].reachable and bool(by_url[failing.base_url].error),
+        by_url[failing.base_url].error,
+    )
+    check(
+        "slow instance is marked slow",
+        by_url[slowest.base_url].slow(slow),
+        f"{by_url[slowest.base_url].seconds:.2f}s",
+    )
+    check(
+        "fast instances are not marked slow",
+        not any(by_url[s.base_url].slow(slow) for s in (fast, other)),
+    )
+    check(
+        "unreachable instance is not marked slow",
+        not by_url[failing.base_url].slow(slow),
+    )
+
+    reachable = [i for i in instances if i.reachable]
+    total = aggregate(instances)
+    expected = {key: sum(number(i.summary[key]) for i in reachable) for key in SUMMED}
+    check(
+        "aggregate adds up the reachable instances",
+        total is not None and all(number(total[key]) == expected[key] for key in SUMMED),
+        ", ".join(f"{key}={total[key]}" for key in SUMMED) if total else "None",
+    )
+    percentage = expected["ads_blocked_today"] * 100 / expected["dns_queries_today"]
+    check(
+        "aggregate percentage is over the totals",
+        total is not None and total["ads_percentage_today"] == f"{percentage:.1f}",
+    )
+    check(
+        "aggregate of unreachable instances is None",
+        aggregate([by_url[failing.base_url]]) is None,
+    )
+    for server in servers:
+        server.shutdown()
+
+
+def check_history(timeout):
+    up = FakePihole().start()
+    down = FakePihole(fail=True).start()
+    servers = [up, down]
+    session = make_session(len(servers))
+    histories = [
+        History(os.path.join(os.environ["XBAR_CACHE_DIR"], f"history-{i}.bin"), 10)
+        for i in range(len(servers))
+    ]
+    for tick in range(4):
+        if tick == 2:
+            # the failing instance comes back for the last two refreshes
+            down.fail = False
+        urls = [server.base_url for server in servers]
+        polled = collect({url: (summary_task(session, url, timeout), timeout) for url in urls})
+        for url, history in zip(urls, histories):
+            instance = Instance.from_result(url, polled[url])
+            if instance.reachable:
+                history.append(1000.0 + tick * 60, sample_values(instance.summary))
+    series = [history.samples() for history in histories]
+    merged = merged_deltas(series, "queries")
+    check(
+        "history is kept while an instance is down",
+        [len(samples) for samples in series] == [4, 2] and merged[0] is not None,
+        repr(merged),
+    )
+    check("instance coming back is a gap", merged[1] is None, repr(merged))
+    check(
+        "increases of both instances add up",
+        merged[2] == (60.0, up.rate + down.rate),
+        repr(merged),
+    )
+    for server in servers:
+        server.shutdown()
+
+
+def check_dns():
+    calls = []
+    dns = DnsReconciler("check-dns.json", 60, calls.append)
+    now = time.time()
+    check("first check is due", dns.due(now))
+
+    dns.update(["10.0.0.2", "10.0.0.1"], ["10.0.0.1", "10.0.0.2"], checked=True, now=now)
+    check("setter not called for equal sets", calls == [], repr(calls))
+    check("no check due within the ttl", not dns.due(now + 30))
+
+    dns.update(["10.0.0.1"], ["10.0.0.1", "10.0.0.2"], checked=True, now=now + 60)
+    check("setter called once for different sets", calls == [["10.0.0.1"]], repr(calls))
+
+    dns.update(["10.0.0.1"], ["10.0.0.1"], checked=True, now=now + 120)
+    check("setter not called again once applied", len(calls) == 1, repr(calls))
+
+    dns.update(checked=True, now=now + 180)
+    check("failed lookups change nothing", len(calls) == 1, repr(calls))
+
+    restored = DnsReconciler("check-dns.json", 60, calls.append)
+    check(
+        "state survives a new run",
+        restored.servers == ["10.0.0.1"] and restored.applied_at == now + 60,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--slow", type=float, default=0.5)
+    options = parser.parse_args()
+    check_instances(options.timeout, options.slow)
+    check_history(options.timeout)
+    check_dns()
+    failed = results.count(False)
+    print(f"{len(results) - failed}/{len(results)} checks passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Local stand-in for the Bitbucket Cloud API used by the benchmark.
+
+Serves a synthetic workspace shaped like the real API responses the
+plugins read: workspace, repositories, pullrequests, refs/branches,
+pipelines, steps and step logs (with Range support). Plain `fields=`
+projections are honoured so their effect on payload size shows up, and
+requests and bytes sent are counted so a benchmark run can report them.
+
+usage: fake_bitbucket.py [--repos 100] [--log-mb 20] [--port 8000]
+"""
+import argparse
+import json
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+
+WORKSPACE = "bench"
+PAGELEN = 10
+MAX_PAGELEN = 100
+
+
+def iso(date):
+    return date.isoformat()
+
+
+def user(i):
+    return {
+        "type": "user",
+        "uuid": f"{{user-{i}}}",
+        "nickname": f"dev{i}",
+        "display_name": f"Developer {i}",
+    }
+
+
+class Workspace:
+    """Synthetic data, generated once and shared by all handler threads."""
+
+    def __init__(self, base_url, repos=100, prs=3, branches=30, log_mb=1):
+        self.base_url = base_url
+        self.now = datetime.now(timezone.utc)
+        self.log = self._make_log(int(log_mb * 1024 * 1024))
+        self.repos = []
+        self.prs = {}
+        self.branches = {}
+        self.pipelines = {}
+        self.steps = {}
+        for i in range(repos):
+            slug = f"repo-{i:04d}"
+            # two thirds of the workspace falls in the 7 day window
+            updated = self.now - timedelta(days=10.5 * i / max(repos, 1))
+            self.repos.append(self._repo(slug, updated))
+            self.prs[slug] = [self._pr(slug, n) for n in range(1, prs + 1)]
+            self.branches[slug] = [self._branch(n) for n in range(branches)]
+            # one repository in ten is building right now
+            building = i % 10 == 0
+            self.pipelines[slug] = [
+                self._pipeline(slug, n, running=building and n == 1)
+                for n in range(1, 4 if building else 2)
+            ]
+            for pipeline in self.pipelines[slug]:
+                running = pipeline["state"]["name"] == "IN_PROGRESS"
+                self.steps[pipeline["uuid"]] = [
+                    self._step(pipeline["uuid"], n, running and n == 2) for n in (1, 2)
+                ]
+
+    @staticmethod
+    def _make_log(size):
+        line = b"+ ./gradlew test --info | tee build.log  [step output]\n"
+        return (line * (size // len(line) + 1))[:size]
+
+    def _repo(self, slug, updated):
+        return {
+            "type": "repository",
+            "slug": slug,
+            "name": slug,
+            "full_name": f"{WORKSPACE}/{slug}",
+            "uuid": f"{{{slug}}}",
+            "updated_on": iso(updated),
+            "links": {
+                "self": {"href": f"{self.base_url}2.0/repositories/{WORKSPACE}/{slug}"},
+                "html": {"href": f"https://bitbucket.org/{WORKSPACE}/{slug}"},
+            },
+        }
+
+    def _pr(self, slug, n):
+        return {
+            "type": "pullrequest",
+            "id": n,
+            "title": f"Feature {n} of {slug}",
+            "state": "OPEN",
+            "author": user(n % 5),
+            "reviewers": [user((n + 1) % 5), user((n + 2) % 5)],
+            "created_on": iso(self.now - timedelta(hours=n * 5)),
+            "updated_on": iso(self.now - timedelta(hours=n)),
+            "source": {"branch": {"name": f"feature/{n}"}},
+            "destination": {"branch": {"name": "develop"}},
+            "links": {
+                "self": {
+                    "href": f"{self.base_url}2.0/repositories/{WORKSPACE}/{slug}/pullrequests/{n}"
+                },
+                "html": {"href": f"https://bitbucket.org/{WORKSPACE}/{slug}/pull-requests/{n}"},
+            },
+        }
+
+    def _branch(self, n):
+        return {
+            "type": "branch",
+            "name": "develop" if n == 0 else f"feature/{n}",
+            "target": {
+                "type": "commit",
+                "hash": f"{n:040x}",
+                "date": iso(self.now - timedelta(hours=n)),
+                "message": f"Change {n}\n\nlonger description of change {n}\n",
+                "author": {"type": "author", "raw": f"dev{n % 5} <dev@example.com>", "user": user(n % 5)},
+            },
+        }
+
+    def _pipeline(self, slug, n, running):
+        if running:
+            state = {"name": "IN_PROGRESS", "type": "pipeline_state_in_progress"}
+        else:
+            state = {"name": "COMPLETED", "result": {"name": "SUCCESSFUL"}}
+        return {
+            "type": "pipeline",
+            "uuid": f"{{{slug}-pipeline-{n}}}",
+            "build_number": n,
+            "created_on": iso(self.now - timedelta(minutes=30 * n)),
+            "completed_on": None if running else iso(self.now - timedelta(minutes=30 * n - 8)),
+            "state": state,
+            "build_seconds_used": 0 if running else 480,
+            "target": {"type": "pipeline_ref_target", "ref_name": "develop"},
+        }
+
+    def _step(self, pipeline_uuid, n, running):
+        if running:
+            state = {"name": "IN_PROGRESS"}
+        else:
+            state = {"name": "COMPLETED", "result": {"name": "SUCCESSFUL"}}
+        return {
+            "type": "pipeline_step",
+            "uuid": f"{{{pipeline_uuid.strip('{}')}-step-{n}}}",
+            "name": "build" if n == 1 else "test",
+            "state": state,
+            "started_on": iso(self.now - timedelta(minutes=3 if running else 30)),
+            "duration_in_seconds": None if running else 240,
+        }
+
+
+def project(data, paths):
+    """Partial response for a `fields=` list of plain dotted paths."""
+    if isinstance(data, list):
+        return [project(value, paths) for value in data]
+    if not isinstance(data, dict):
+        return data
+    tree = {}
+    for path in paths:
+        head, _, rest = path.partition(".")
+        tree.setdefault(head, []).append(rest)
+    return {
+        key: data[key] if "" in rests else project(data[key], rests)
+        for key, rests in tree.items()
+        if key in data
+    }
+
+
+ROUTES = [
+    (re.compile(r"^/2\.0/workspaces/(?P<ws>[^/]+)$"), "workspace"),
+    (re.compile(r"^/2\.0/repositories/(?P<ws>[^/]+)$"), "repositories"),
+    (re.compile(r"^/2\.0/repositories/(?P<ws>[^/]+)/(?P<slug>[^/]+)$"), "repository"),
+    (re.compile(r"^/2\.0/repositories/[^/]+/(?P<slug>[^/]+)/pullrequests$"), "pullrequests"),
+    (re.compile(r"^/2\.0/repositories/[^/]+/(?P<slug>[^/]+)/refs/branches$"), "branches"),
+    (re.compile(r"^/2\.0/repositories/[^/]+/(?P<slug>[^/]+)/pipelines$"), "pipelines"),
+    (
+        re.compile(r"^/2\.0/repositories/[^/]+/[^/]+/pipelines/(?P<pipeline>[^/]+)/steps$"),
+        "steps",
+    ),
+    (
+        re.compile(r"^/2\.0/repositories/[^/]+/[^/]+/pipelines/[^/]+/steps/[^/]+/log$"),
+        "log",
+    ),
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).rstrip("/")
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        for pattern, name in ROUTES:
+            match = pattern.match(path)
+            if match:
+                return getattr(self, f"get_{name}")(**match.groupdict())
+        self.send_json({"type": "error", "error": {"message": "not found"}}, 404)
+
+    def send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(len(body))
+
+    def send_json(self, data, status=200):
+        fields = self.query.get("fields", "").split(",")
+        # +/- fields only add to or trim the default response, served in full
+        # errors are not projected
+        if status < 400 and fields != [""] and not any(f.startswith(("+", "-")) for f in fields):
+            data = project(data, fields)
+        body = json.dumps(data).encode("utf-8")
+        self.send_body(body, status, {"Content-Type": "application/json"})
+
+    def send_page(self, values):
+        page = int(self.query.get("page", 1))
+        pagelen = min(int(self.query.get("pagelen", PAGELEN)), MAX_PAGELEN)
+        chunk = values[(page - 1) * pagelen : page * pagelen]
+        data = {"values": chunk, "page": page, "pagelen": pagelen, "size": len(values)}
+        if page * pagelen < len(values):
+            query = dict(self.query, page=page + 1, pagelen=pagelen)
+            path = urlsplit(self.path).path
+            data["next"] = f"{self.server.base_url.rstrip('/')}{path}?{urlencode(query)}"
+        self.send_json(data)
+
+    @property
+    def data(self):
+        return self.server.workspace
+
+    def get_workspace(self, ws):
+        base = f"{self.server.base_url}2.0"
+        self.send_json(
+            {
+                "type": "workspace",
+                "slug": ws,
+                "name": ws,
+                "uuid": "{workspace}",
+                "links": {
+                    "self": {"href": f"{base}/workspaces/{ws}"},
+                    "repositories": {"href": f"{base}/repositories/{ws}"},
+                    "projects": {"href": f"{base}/workspaces/{ws}/projects"},
+                    "members": {"href": f"{base}/workspaces/{ws}/members"},
+                },
+            }
+        )
+
+    def get_repositories(self, ws):
+        repos = self.data.repos
+        match = re.search(r"updated_on\s*>\s*(\S+)", self.query.get("q", ""))
+        if match:
+            since = datetime.fromisoformat(match.group(1).strip('"').replace("Z", "+00:00"))
+            repos = [r for r in repos if datetime.fromisoformat(r["updated_on"]) > since]
+        self.send_page(repos)
+
+    def get_repository(self, ws, slug):
+        repo = next((r for r in self.data.repos if r["slug"] == slug), None)
+        if repo is None:
+            return self.send_json({"type": "error"}, 404)
+        self.send_json(repo)
+
+    def missing(self, slug):
+        """Answer 404, like the API, for a repository that is gone."""
+        if any(r["slug"] == slug for r in self.data.repos):
+            return False
+        self.send_json({"type": "error", "error": {"message": "Repository not found"}}, 404)
+        return True
+
+    def refused(self, fields):
+        """Answer 400, like the API, when q= compares a field outside `fields`."""
+        for field in re.findall(r"([a-z_][\w.]*)\s*(?:!=|=|~|>|<)", self.query.get("q", "")):
+            if field not in fields:
+                self.send_json({"type": "error", "error": {"message": f"Invalid field {field}"}}, 400)
+                return True
+        return False
+
+    def get_pullrequests(self, slug):
+        if self.missing(slug):
+            return
+        if not self.refused(("state", "author.nickname", "destination.branch.name")):
+            self.send_page(self.data.prs.get(slug, []))
+
+    def get_branches(self, slug):
+        if self.missing(slug):
+            return
+        if not self.refused(("name", "target.date")):
+            self.send_page(self.data.branches.get(slug, []))
+
+    def get_pipelines(self, slug):
+        if self.missing(slug):
+            return
+        self.send_page(self.data.pipelines.get(slug, []))
+
+    def get_steps(self, pipeline):
+        self.send_page(self.data.steps.get(pipeline, []))
+
+    def get_log(self):
+        log = self.data.log
+        match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match is None:
+            return self.send_body(log, headers={"Content-Type": "application/octet-stream"})
+        start, end = match.groups()
+        if start == "":
+            start, end = max(0, len(log) - int(end)), len(log) - 1
+        else:
+            start, end = int(start), int(end) if end else len(log) - 1
+        if start >= len(log):
+            return self.send_body(b"", 416, {"Content-Range": f"bytes */{len(log)}"})
+        self.send_body(
+            log[start : end + 1],
+            206,
+            {
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes {start}-{end}/{len(log)}",
+            },
+        )
+
+
+class FakeBitbucket(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, **workspace_options):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server_port}/"
+        self.workspace = Workspace(self.base_url, **workspace_options)
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def count(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def reset_counters(self):
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repos", type=int, default=100)
+    parser.add_argument("--log-mb", type=float, default=1)
+    parser.add_argument("--port", type=int, default=8000)
+    options = parser.parse_args()
+    server = FakeBitbucket(options.port, repos=options.repos, log_mb=options.log_mb)
+    print(f"serving workspace {WORKSPACE!r} on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Local stand-ins for pi-hole instances.
+
+Each server answers `/admin/api.php?summary` with counters that grow on
+every request, optionally after a delay or with an error, so the plugin
+can be run against several instances, including slow and broken ones.
+
+usage: fake_pihole.py [--instances 3] [--delay 0,0,5] [--fail 0,0,0] [--port 8100]
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path != "/admin/api.php" or parts.query != "summary":
+            return self.send_json({"error": "not found"}, 404)
+        time.sleep(self.server.delay)
+        if self.server.fail:
+            return self.send_json({"error": "failing on purpose"}, 500)
+        self.send_json(self.server.summary())
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakePihole(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0, fail=False, rate=100):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server_port}/admin"
+        self.delay = delay
+        self.fail = fail
+        self.rate = rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def summary(self):
+        with self._lock:
+            self.requests += 1
+            queries = 1000 + self.requests * self.rate
+        blocked = queries // 5
+        # formatted like the real api.php?summary
+        return {
+            "domains_being_blocked": f"{150000:,}",
+            "dns_queries_today": f"{queries:,}",
+            "ads_blocked_today": f"{blocked:,}",
+            "ads_percentage_today": f"{blocked * 100 / queries:.1f}",
+            "unique_domains": f"{queries // 10:,}",
+            "queries_forwarded": f"{queries // 2:,}",
+            "queries_cached": f"{queries // 4:,}",
+        }
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--delay", default="", help="seconds per instance, comma separated")
+    parser.add_argument("--fail", default="", help="1 for a failing instance, comma separated")
+    parser.add_argument("--port", type=int, default=8100)
+    options = parser.parse_args()
+    delays = [float(d) for d in options.delay.split(",") if d]
+    fails = [d == "1" for d in options.fail.split(",") if d]
+    servers = [
+        FakePihole(
+            options.port + i,
+            delay=delays[i] if i < len(delays) else 0,
+            fail=fails[i] if i < len(fails) else False,
+        ).start()
+        for i in range(options.instances)
+    ]
+    print("VAR_BASE_URL=" + ",".join(server.base_url for server in servers))
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#! /usr/local/bin/python3
+"""Benchmark the Bitbucket plugins against a local API stand-in.
+
+usage: run_bench.py [--sizes 10,100,1000] [--log-mb 20] [--runs 3] [--plugins pr.1m.py,...]
+
+Each plugin runs as xbar would start it, once per run, against a
+synthetic workspace served by fake_bitbucket.py. The first run starts
+from an empty cache directory, later runs reuse it, so cold and warm
+refreshes both show up. Wall time, request count, bytes sent by the
+server and the peak RSS of the plugin process are reported.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fake_bitbucket import WORKSPACE, FakeBitbucket
+
+PLUGIN_DIR = Path(__file__).parent.parent
+PLUGINS = ["pr.1m.py", "pipeline.1m.py"]
+
+
+def run_plugin(plugin, server, cache_dir, cwd):
+    env = dict(os.environ)
+    env.update(
+        BITBUCKET_API_URL=server.base_url,
+        XBAR_CACHE_DIR=cache_dir,
+        VAR_USERNAME="bench",
+        VAR_PASSWORD="bench",
+        VAR_WORKSPACE=WORKSPACE,
+        PYTHONDONTWRITEBYTECODE="1",
+    )
+    server.reset_counters()
+    started = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, (PLUGIN_DIR / plugin).as_posix()],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    output = proc.stdout.read()
+    # wait4 reports the resource usage of this child alone
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_ms = (time.monotonic() - started) * 1000
+    # ru_maxrss is in KiB on linux, bytes on macOS
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {
+        "wall_ms": wall_ms,
+        "requests": server.requests,
+        "bytes": server.bytes_sent,
+        "rss_mb": rss_mb,
+        "lines": output.count(b"\n"),
+        "status": proc.returncode,
+    }
+
+
+def report(plugin, size, run, result):
+    label = "cold" if run == 0 else "warm"
+    print(
+        f"{plugin:16} {size:5} repos  {label} {result['wall_ms']:8.0f}ms"
+        f" {result['requests']:6} req {result['bytes'] / 1024:9.0f}KiB"
+        f" {result['rss_mb']:6.1f}MiB rss {result['lines']:6} lines"
+        + (f"  exit {result['status']}" if result["status"] else "")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000")
+    parser.add_argument("--log-mb", type=float, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--plugins", default=",".join(PLUGINS))
+    options = parser.parse_args()
+
+    # fd limit for the server threads at the larger sizes
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(4096, hard), hard))
+
+    for size in (int(s) for s in options.sizes.split(",")):
+        server = FakeBitbucket(repos=size, log_mb=options.log_mb).start()
+        try:
+            for plugin in options.plugins.split(","):
+                with tempfile.TemporaryDirectory() as cwd:
+                    # the plugins log to ./logs
+                    (Path(cwd) / "logs").mkdir()
+                    cache_dir = (Path(cwd) / "cache").as_posix()
+                    for run in range(options.runs):
+                        report(plugin, size, run, run_plugin(plugin, server, cache_dir, cwd))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,20 +11,43 @@
 #  <xbar.var>string(VAR_USERNAME="username"): Username.</xbar.var>
 #  <xbar.var>string(VAR_PASSWORD="password"): App Password.</xbar.var>
 #  <xbar.var>string(VAR_WORKSPACE=""): Your WORKSPACE.</xbar.var>
+#  <xbar.var>number(VAR_POOL_SIZE=10): HTTP connection pool size.</xbar.var>
+#  <xbar.var>number(VAR_TIMEOUT=15): HTTP timeout in seconds.</xbar.var>
+#  <xbar.var>boolean(VAR_DAEMON=false): Render in a background daemon and print its latest snapshot.</xbar.var>
+#  <xbar.var>number(VAR_DAEMON_INTERVAL=60): Seconds between daemon refreshes.</xbar.var>
+#  <xbar.var>boolean(VAR_SNAPSHOT=false): Print the last menu at once and refresh it in the background.</xbar.var>
+#  <xbar.var>number(VAR_CACHE_TTL=120): Seconds API responses are reused before revalidating, 0 disables the cache.</xbar.var>
+#  <xbar.var>number(VAR_DATA_TTL=50): Seconds the workspace data shared by the pr and pipeline plugins is reused.</xbar.var>
+#  <xbar.var>number(VAR_RATE_LIMIT=1000): API requests per hour shared by all Bitbucket plugins and actions.</xbar.var>
+#  <xbar.var>number(VAR_CONCURRENCY=8): Max repositories and pipelines fetched in parallel.</xbar.var>
+#  <xbar.var>number(VAR_PIPELINE_HOURS=2): Show pipelines started in the last N hours.</xbar.var>
+#  <xbar.var>number(VAR_LOG_CONCURRENCY=4): Max step logs downloaded in parallel.</xbar.var>
+#  <xbar.var>number(VAR_LOG_TAIL_KB=16): KB read from the end of a running step log.</xbar.var>
+#  <xbar.var>number(VAR_LOG_LINES=30): Lines shown from a running step log.</xbar.var>
+#  <xbar.var>number(VAR_DIAGNOSTICS_TOP=10): Slowest API calls listed under Diagnostics (hold option).</xbar.var>
 #%%
 import logging
 import os
 import sys
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zoneinfo import ZoneInfo
 
-import pytz
-from atlassian import Bitbucket
-from atlassian.bitbucket.cloud import Cloud
-from pytz import timezone
+SCRIPTS_DIR = (Path(__file__).parent / "scripts").as_posix()
+# the daemon runs the plugin again and again in one process
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+from bitbucket_snapshot import serve_snapshot
 
-print("Pipeline")
-print("---")
-print("Refresh | refresh=true")
+if serve_snapshot("pipeline", __file__):
+    sys.exit(0)
+
+from xbar_menu import Menu
+
+menu = Menu()
+menu.add("Pipeline")
+menu.separator()
+menu.add("Refresh", refresh=True)
 
 FORMAT = "%(asctime)-15s %(threadName)s %(filename)-15s:%(lineno)d %(levelname)-8s: %(message)s"
 logging.basicConfig(
@@ -38,6 +61,7 @@ LOGGER = logging.getLogger()
 USERNAME = os.environ.get("VAR_USERNAME")
 PASSWORD = os.environ.get("VAR_PASSWORD")
 WORKSPACE = os.environ.get("VAR_WORKSPACE")
+LOG_CONCURRENCY = max(1, int(os.environ.get("VAR_LOG_CONCURRENCY") or 4))
 
 SUCCESS_COLOR = "#3A855D"
 PROGRESS_COLOR = "#2A63F6"
@@ -46,23 +70,34 @@ FAILED_COLOR = "#CD4425"
 PEDING_COLOR = "#7E8BA7"
 
 
-jst = timezone("Asia/Tokyo")
+jst = ZoneInfo("Asia/Tokyo")
 
 
 def humanize_date(date):
     return date.astimezone(jst).strftime("%Y/%m/%d %H:%M:%S")
 
 
+def humanize_seconds(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
 if USERNAME is None or PASSWORD is None or WORKSPACE is None:
-    print("Setup VAR")
+    menu.add("Setup VAR")
+    menu.write()
     sys.exit(0)
 
-cloud = Cloud(
-    url="https://api.bitbucket.org/",
-    username=USERNAME,
-    password=PASSWORD,
-    cloud=True,
-)
+from bitbucket_trace import add_diagnostics, start_trace
+
+trace = start_trace("pipeline")
+# shown in place of Refresh while the option key is held
+diagnostics = menu.add("Diagnostics", alternate=True)
+
+from bitbucket_data import FetchError, load_workspace, parse_time
+from bitbucket_query import QueryError
+from bitbucket_ratelimit import RateLimited
+from bitbucket_logs import LogTails, log_key
+from bitbucket_history import History, elapsed, percentile
 
 STEP_COLOR_MAP = {
     "PENDING": PEDING_COLOR,
@@ -72,78 +107,115 @@ STEP_COLOR_MAP = {
     "SUCCESSFUL": SUCCESS_COLOR,
 }
 
-# %%
-workspace = cloud.workspaces.get(WORKSPACE)
-
-data = []
 
+# %%
+try:
+    data = load_workspace(USERNAME, PASSWORD, WORKSPACE)
+except QueryError as e:
+    menu.add(f"Invalid filter: {e}", color=FAILED_COLOR)
+    menu.write()
+    sys.exit(0)
+except RateLimited:
+    menu.add("Rate limited, waiting for API budget", color=FAILED_COLOR)
+    menu.write()
+    sys.exit(0)
+except FetchError as e:
+    menu.add(f"API error: {e}", color=FAILED_COLOR)
+    menu.write()
+    sys.exit(0)
 
-def get_status(state):
-    if "result" in state.keys():
-        return state["result"]["name"]
-    return state["name"]
-
-
-def iso_format(offset):
-    d = datetime.utcnow().replace(tzinfo=pytz.utc) + offset
-    return d.isoformat()
-
+log_tails = LogTails()
 
-now = datetime.utcnow().replace(tzinfo=pytz.utc)
 
-# https://github.dev/atlassian-api/atlassian-python-api
-for repo in workspace.repositories.each(
-    q=f"updated_on > {iso_format(-timedelta(days=7))}",
-    sort="-updated_on",
-):
-    if repo.get_time("updated_on") < now - timedelta(days=7):
-        break
-    LOGGER.info("repo: %s", repo.name)
-    last_pipelines = []
+def fetch_log(running_step):
+    repo, pipeline, step = running_step
+    key = log_key(repo.name, pipeline.build_number, step.uuid)
+    url = (
+        f"{API_URL}2.0/repositories/{WORKSPACE}/{repo.slug}"
+        f"/pipelines/{pipeline.uuid}/steps/{step.uuid}/log"
+    )
+    return log_tails.tail(session, key, url)
+
+
+running = [
+    (repo, pipeline, step)
+    for repo in data
+    for pipeline in repo.pipelines
+    for step in pipeline.steps
+    if step.running
+]
+logs = {}
+if running:
+    # logs are fetched per plugin, only a running step needs requests
+    from bitbucket_http import API_URL, get_session
+
+    session = get_session(USERNAME, PASSWORD)
+    with trace.span("logs"), ThreadPoolExecutor(max_workers=LOG_CONCURRENCY) as executor:
+        logs = dict(
+            zip([step.uuid for _, _, step in running], executor.map(fetch_log, running))
+        )
+# offsets of pipelines that left the recency window are dropped
+log_tails.retain(
+    (repo.name, pipeline.build_number)
+    for repo in data
+    for pipeline in repo.pipelines
+)
+log_tails.save()
 
-    for pipeline in repo.pipelines.each(sort="-created_on"):
-        if pipeline.created_on < now - timedelta(hours=2):
-            break
-        last_pipelines.append(pipeline)
-        LOGGER.info("pipelines: %s, %s", pipeline.build_number, pipeline.created_on)
-    LOGGER.info("pipelines size: %d", len(last_pipelines))
-    data.append({"repo": repo.name, "pipelines": last_pipelines})
+history = History()
+with trace.span("history"):
+    history.record(data)
 
 #%%
 
-for repo in data:
-    repo_name = repo["repo"]
-    print("---")
-    print(
-        f"{repo_name} | href=https://bitbucket.org/{WORKSPACE}/{repo_name} |color=#D0D0D0|size=12"
-    )
-    for pipeline in repo["pipelines"]:
-        pipeline_url = f"https://bitbucket.org/{WORKSPACE}/{repo_name}/addon/pipelines/home#!/results/{pipeline.build_number}"
-        steps = list(pipeline.steps())
-        target = pipeline.get_data("target")
-        target_name = "-"
-        if target["type"] == "pipeline_ref_target":
-            target_name = target["ref_name"]
-        elif target["type"] == "pipeline_pullrequest_target":
-            target_name = target["source"]
-        params = [
-            f"#{pipeline.build_number}[{target_name}]:({pipeline.build_seconds_used or '0'}s)-{get_status(pipeline.get_data('state'))}",
-            f"href={pipeline_url}",
-            f"color={STEP_COLOR_MAP.get(get_status(pipeline.get_data('state')), FAILED_COLOR)}",
-        ]
-        print("|".join(params))
-        print(f"--created_on:{humanize_date(pipeline.created_on)}")
-        for step in steps:
-            step_params = [
-                f"--({get_status(step.state)}-{step.duration_in_seconds or 0}s)-{step.get_data('name')}",
-                f"color={STEP_COLOR_MAP.get(get_status(step.state), FAILED_COLOR)} ",
-                f"href={pipeline_url}",
-            ]
-            print("|".join(step_params))
-            if step.state["name"] == "IN_PROGRESS":
-                log_text = step.log() or ""
-                if isinstance(log_text, bytes):
-                    log_text = log_text.decode("utf-8")
-                for line in log_text.split("\n"):
-                    sys.stdout.write("----" + line.replace("|", "｜") + "\n")
+with trace.span("render"):
+    for repo in data:
+        repo_name = repo.name
+        menu.separator()
+        menu.add(
+            repo_name,
+            href=f"https://bitbucket.org/{WORKSPACE}/{repo_name}",
+            color="#D0D0D0",
+            size=12,
+        )
+        step_stats = history.step_stats(repo_name)
+        if step_stats:
+            durations = menu.add("Durations (p50 / p95)")
+            runs = history.pipeline_durations(repo_name)
+            if runs:
+                durations.add(
+                    f"pipeline: {humanize_seconds(percentile(runs, 50))}"
+                    f" / {humanize_seconds(percentile(runs, 95))} ({len(runs)} runs)"
+                )
+            for name, (p50, p95, count) in step_stats.items():
+                durations.add(
+                    f"{name or '-'}: {humanize_seconds(p50)}"
+                    f" / {humanize_seconds(p95)} ({count} runs)"
+                )
+        for pipeline in repo.pipelines:
+            pipeline_url = f"https://bitbucket.org/{WORKSPACE}/{repo_name}/addon/pipelines/home#!/results/{pipeline.build_number}"
+            item = menu.add(
+                f"#{pipeline.build_number}[{pipeline.target_name}]:({pipeline.build_seconds_used or '0'}s)-{pipeline.status}",
+                href=pipeline_url,
+                color=STEP_COLOR_MAP.get(pipeline.status, FAILED_COLOR),
+            )
+            item.add(f"created_on:{humanize_date(parse_time(pipeline.created_on))}")
+            for step in pipeline.steps:
+                title = f"({step.status}-{int(elapsed(step))}s)-{step.name}"
+                if step.running:
+                    left, p50 = history.eta(repo_name, pipeline.target_name, step)
+                    if left is not None:
+                        title += f" ETA ~{humanize_seconds(left)} (p50 {humanize_seconds(p50)})"
+                step_item = item.add(
+                    title,
+                    color=STEP_COLOR_MAP.get(step.status, FAILED_COLOR),
+                    href=pipeline_url,
+                )
+                for line in logs.get(step.uuid, ()):
+                    step_item.add(line)
+
+history.close()
+add_diagnostics(diagnostics, trace)
+menu.write()
+trace.write()
 # %%
@@ -11,33 +11,53 @@
 #  <xbar.var>string(VAR_USERNAME="username"): Username.</xbar.var>
 #  <xbar.var>string(VAR_PASSWORD="password"): App Password.</xbar.var>
 #  <xbar.var>string(VAR_WORKSPACE=""): Your WORKSPACE.</xbar.var>
+#  <xbar.var>number(VAR_POOL_SIZE=10): HTTP connection pool size.</xbar.var>
+#  <xbar.var>number(VAR_TIMEOUT=15): HTTP timeout in seconds.</xbar.var>
+#  <xbar.var>boolean(VAR_DAEMON=false): Render in a background daemon and print its latest snapshot.</xbar.var>
+#  <xbar.var>number(VAR_DAEMON_INTERVAL=60): Seconds between daemon refreshes.</xbar.var>
+#  <xbar.var>boolean(VAR_SNAPSHOT=false): Print the last menu at once and refresh it in the background.</xbar.var>
+#  <xbar.var>number(VAR_CACHE_TTL=120): Seconds API responses are reused before revalidating, 0 disables the cache.</xbar.var>
+#  <xbar.var>number(VAR_DATA_TTL=50): Seconds the workspace data shared by the pr and pipeline plugins is reused.</xbar.var>
+#  <xbar.var>number(VAR_RATE_LIMIT=1000): API requests per hour shared by all Bitbucket plugins and actions.</xbar.var>
 #  <xbar.var>string(VAR_MY_NICKNAME=""): Your Nickname.</xbar.var>
 #  <xbar.var>string(VAR_REVIEWERS=""): Your reviewers UUID.</xbar.var>
+#  <xbar.var>number(VAR_CONCURRENCY=8): Max repositories fetched in parallel.</xbar.var>
+#  <xbar.var>number(VAR_MAX_BRANCHES=20): Max branches shown per repository, 0 for all.</xbar.var>
+#  <xbar.var>number(VAR_REPO_DAYS=7): Show repositories updated in the last N days, in the pipeline plugin too.</xbar.var>
+#  <xbar.var>number(VAR_BRANCH_DAYS=0): Show branches with commits in the last N days, 0 for all.</xbar.var>
+#  <xbar.var>boolean(VAR_ONLY_MY_PRS=false): Only list pull requests authored by VAR_MY_NICKNAME.</xbar.var>
+#  <xbar.var>string(VAR_PROTECTED_BRANCHES="master,develop,main,dev,sandbox"): Branches that get no delete action.</xbar.var>
+#  <xbar.var>boolean(VAR_HIDE_PROTECTED=false): Leave the protected branches out of the branch list.</xbar.var>
+#  <xbar.var>string(VAR_PR_FILTER=""): Extra pull request filter, e.g. destination.branch.name = "develop".</xbar.var>
+#  <xbar.var>string(VAR_BRANCH_FILTER=""): Extra branch filter, e.g. name ~ "feature/".</xbar.var>
+#  <xbar.var>number(VAR_DIAGNOSTICS_TOP=10): Slowest API calls listed under Diagnostics (hold option).</xbar.var>
 #%%
-import json
 import logging
 import os
 import sys
-from base64 import b64encode
-from datetime import datetime, timedelta
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
-import pytz
-import requests
-from atlassian import Bitbucket
-from atlassian.bitbucket.cloud import Cloud
-from atlassian.bitbucket.cloud.common.users import User
-from atlassian.bitbucket.cloud.repositories.pullRequests import PullRequest
-from pytz import timezone
+SCRIPTS_DIR = (Path(__file__).parent / "scripts").as_posix()
+# the daemon runs the plugin again and again in one process
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+from bitbucket_snapshot import serve_snapshot
+
+if serve_snapshot("pr", __file__):
+    sys.exit(0)
+
+from xbar_menu import Menu, encode_params
 
 BRANCH_ICON = "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAABmJLR0QA/wD/AP+gvaeTAAAA4UlEQVQ4jbXTPU4CURQF4I+JizBGlCWYYOU2YCH2LoBK0J7OSjZibEwktDairTgljVh4R99M3iRjoqd5P+fc8+5PHn+IUyxRYoZewvVwhffQDHMGK6yxwA7jhBvF3SI0y4ooElEfd5jE+TDhBrFOQtPPZTCLV3Z4w3HDYJPwlzmDAvMQHGX4QXBzSX/SEj7wEvvnjEGV9n0Ygb1cKnjFQeb+yVcjv9Fm8ICbluCyi8EY2xauhqKxr+rc7xLcxLWfMW3Ux9gJJW5xEibnXYLSEtY4w0Vy/hWGeIxMpuqf6f/wCZenMrU2gp2KAAAAAElFTkSuQmCC"
 PR_ICON = "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAABmJLR0QA/wD/AP+gvaeTAAAA2UlEQVQ4jc3SMU4CURDG8R9WdJzAZI+AUJl4AHsbL4AHkILEigsQPYAHMHoAr0HsTQzSAxV0a7HzkhfyFtDKL9nMvplv/m+yO5ym/jFDB09Y4wPDrHaN7THADWq84jsgeXONCe7QKwHGYboIyCryb5HPn88SpIqmZJpFvov3yMFVvI9KU1RRfNZ8k6QuXrJzjWk6nGWFr4jL7EbY4bZ04z7gT/pfgCri+QFwq6fSbGH6jY8tza2e+0j2NYu0LgCKnjTGIuIDLjXrvK+Dnk6MtMEcgwLgFM/v9QO0iTrGPnzHMAAAAABJRU5ErkJggg=="
 REPO_ICON = "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAABmJLR0QA/wD/AP+gvaeTAAAArUlEQVQ4je3TPQoCMRCG4UdZbLyCYG1nr4ew8iq2W9kuCNYeRE8hiKUH8ACLgqxNVuPP/tj7wsCQfPNlwiQ8GWKHC4qGOJRFnchghzE2uKlmislbLeHkZU1hSRq6AN1oo4drC4MXus2Sv8EvFDhr95AeY0zeTBKs1Y+zfEgfXLBq0WkadxCzxSnkedRqHtbmWATdV4MBZiH/dt+9hs8UU+AY8lGNrpIM/RBZnfAOVrU17mdpFrEAAAAASUVORK5CYII="
 
 
-print(f"| image={PR_ICON}")
-print("---")
-print("Refresh | refresh=true")
+menu = Menu()
+menu.add("", image=PR_ICON)
+menu.separator()
+menu.add("Refresh", refresh=True)
 
 logging.basicConfig(filename="./logs/pr.log", encoding="utf-8", level=logging.INFO)
 LOGGER = logging.getLogger()
@@ -51,7 +71,7 @@ MY_NICKNAME = os.environ.get("VAR_MY_NICKNAME")
 curdir = Path(__file__).parent
 
 
-jst = timezone("Asia/Tokyo")
+jst = ZoneInfo("Asia/Tokyo")
 
 
 def humanize_date(date, fmt="%Y/%m/%d %H:%M:%S"):
@@ -59,214 +79,182 @@ def humanize_date(date, fmt="%Y/%m/%d %H:%M:%S"):
 
 
 if USERNAME is None or PASSWORD is None or WORKSPACE is None:
-    print("Setup VAR")
+    menu.add("Setup VAR")
+    menu.write()
     sys.exit(0)
 
-cloud = Cloud(
-    url="https://api.bitbucket.org/",
-    username=USERNAME,
-    password=PASSWORD,
-    cloud=True,
-)
+from bitbucket_trace import add_diagnostics, start_trace
+
+trace = start_trace("pr")
+# shown in place of Refresh while the option key is held
+diagnostics = menu.add("Diagnostics", alternate=True)
 
+from bitbucket_data import PROTECTED_BRANCHES, FetchError, load_workspace, parse_time
+from bitbucket_query import QueryError
+from bitbucket_ratelimit import RateLimited
 
 def is_me_color(author):
-    if author is not None:
-        if not isinstance(author, User):
-            author = User(None, data=author)
-        if author.nickname == MY_NICKNAME:
-            return "#3A855D"
+    if author is not None and author == MY_NICKNAME:
+        return "#3A855D"
     return "#09F4F7FB"
 
 
 # %%
-workspace = cloud.workspaces.get(WORKSPACE)
-
-data = []
-
-
-class Branch(dict):
-    def __getattr__(self, attr):
-        return self.get(attr)
-
-
-def each_branch(repo_name):
-    url = f"https://api.bitbucket.org/2.0/repositories/{WORKSPACE}/{repo_name}/refs/branches"
-    fields = [
-        "-values.target.repository",
-        "-values.target.parents",
-    ]
-    params = {
-        "fields": ",".join(fields),
-        "pagelen": 20,
-        # "sort": "-target.date",
-        # "q": "(ahead > 0 OR ahead = null)",
-    }
-    res = requests.get(
-        url,
-        params=params,
-        headers={"Content-Type": "application/json"},
-        auth=(USERNAME, PASSWORD),
-    )
-    data = res.json()
-    LOGGER.info(json.dumps(data, indent=2))
-    return [Branch(b) for b in data["values"]], data["size"]
-
-
-def each_pull_request(obj, q=None, sort=None):
-    params = {"fields": "+values.reviewers"}
-    if sort is not None:
-        params["sort"] = sort
-    if q is not None:
-        params["q"] = q
-    for pr in obj._get_paged(None, trailing=True, params=params):
-        yield PullRequest(pr, **obj._new_session_args)
-
-
-now = datetime.utcnow().replace(tzinfo=pytz.utc)
-# https://github.dev/atlassian-api/atlassian-python-api
-for repo in workspace.repositories.each(sort="-updated_on"):
-    if repo.get_time("updated_on") < now - timedelta(days=7):
-        continue
-    # print(repo.name)
-    pullrequests = each_pull_request(
-        repo.pullrequests, sort="-created_on", q='state = "open"'
-    )
-    branches, branches_size = each_branch(repo.name)
-    data.append(
-        {
-            "repo": repo.name,
-            "pullrequests": filter(lambda p: p.is_open, pullrequests),
-            "branches": branches,
-            "branches_size": branches_size,
-        }
-    )
+try:
+    data = load_workspace(USERNAME, PASSWORD, WORKSPACE)
+except QueryError as e:
+    menu.add(f"Invalid filter: {e}")
+    menu.write()
+    sys.exit(0)
+except RateLimited:
+    menu.add("Rate limited, waiting for API budget")
+    menu.write()
+    sys.exit(0)
+except FetchError as e:
+    menu.add(f"API error: {e}")
+    menu.write()
+    sys.exit(0)
 
 #%%
-shell_file = f"\"{(curdir / 'scripts/bitbucket_ops.py').as_posix()}\""
+shell_file = (curdir / "scripts/bitbucket_ops.py").as_posix()
 
 
-def encode_shell_params(params):
-    return b64encode(json.dumps(params).encode("utf-8")).decode("utf-8")
+def add_action(parent, title, shell_params):
+    parent.add(
+        title,
+        shell=shell_file,
+        param1=encode_params(shell_params),
+        terminal=True,
+    )
 
 
-def render_new_pr(repo_name):
+def render_new_pr(parent, repo_name):
     pr_params = {
         "repo_name": repo_name,
         "fun": None,
     }
-    print("new")
+    new = parent.add("new")
     pr_params["fun"] = "release_pr"
-    print(
-        f"--release PR| shell={shell_file} | param1={encode_shell_params(pr_params)} | terminal=true"
-    )
+    add_action(new, "release PR", pr_params)
     pr_params["fun"] = "hotfix_pr"
-    print(
-        f"--hotfix PR| shell={shell_file} | param1={encode_shell_params(pr_params)} |  terminal=true"
-    )
+    add_action(new, "hotfix PR", pr_params)
     pr_params["fun"] = "merge_to_sandbox"
-    print(
-        f"--merge to sandbox| shell={shell_file} |param1={encode_shell_params(pr_params)} | terminal=true"
-    )
+    add_action(new, "merge to sandbox", pr_params)
 
 
-def render_pr(pr: PullRequest, repo_name):
+def render_pr(parent, pr, repo_name):
     pr_url = f"https://bitbucket.org/{WORKSPACE}/{repo_name}/pull-requests/{pr.id}"
-    params = [
+    item = parent.add(
         f"#{pr.id}-{pr.title}",
-        f"color={is_me_color(pr.author)}",
-        f"href={pr_url}",
-        f"templateImage={PR_ICON}",
-    ]
-    print("|".join(params))
+        color=is_me_color(pr.author),
+        href=pr_url,
+        templateImage=PR_ICON,
+    )
     shell_params = {
         "repo_name": repo_name,
         "source_branch": pr.source_branch,
         "fun": "merge_sandbox",
     }
-    print(
-        f"--merge to sandbox|shell={shell_file}|param1={encode_shell_params(shell_params)} | terminal=true"
-    )
+    add_action(item, "merge to sandbox", shell_params)
     shell_params["fun"] = "merge_pr"
     shell_params["pr_id"] = pr.id
-    print(
-        f"--merge|shell={shell_file}|param1={encode_shell_params(shell_params)} | terminal=true"
-    )
+    # lets a batch run merges into the same branch one at a time
+    shell_params["destination_branch"] = pr.destination_branch
+    add_action(item, "merge", shell_params)
     shell_params["fun"] = "decline_pr"
-    print(
-        f"--decline|shell={shell_file}|param1={encode_shell_params(shell_params)} | terminal=true"
-    )
+    add_action(item, "decline", shell_params)
 
     shell_params["fun"] = "pr_add_review"
-    print(
-        f"--add reviewers|shell={shell_file}|param1={encode_shell_params(shell_params)} | terminal=true"
+    add_action(item, "add reviewers", shell_params)
+    item.add(f"author: {pr.author}")
+    item.add(f"reviewer: {','.join(filter(None, pr.reviewers))}")
+    item.add(f"created at: {humanize_date(parse_time(pr.created_on))}")
+    item.add(f"updated at: {humanize_date(parse_time(pr.updated_on))}")
+    item.add(f"source: {pr.source_branch}")
+    item.add(f"dest: {pr.destination_branch}")
+
+
+def render_branch(parent, branch, repo_name):
+    url = f"https://bitbucket.org/{WORKSPACE}/{repo_name}/branch/{branch.name}"
+    item = parent.add(
+        branch.name,
+        color=is_me_color(branch.author),
+        href=url,
+        templateImage=BRANCH_ICON,
     )
-    print(f"--author: {pr.author.nickname}")
-    print(f"--reviewer: {','.join([user.nickname for user in pr.reviewers()])}")
-    print(f"--created at: {humanize_date(pr.created_on)}")
-    print(f"--updated at: {humanize_date(pr.updated_on)}")
-    print(f"--source: {pr.source_branch}")
-    print(f"--dest: {pr.destination_branch}")
-
-
-def render_branch(branch, repo_name):
-    url = f"https://bitbucket.org/{WORKSPACE}/{repo_name}/branch/{branch['name']}"
-    params = [
-        f"--{branch['name']}",
-        f"color={is_me_color(branch['target']['author'].get('user'))}",
-        f"href={url}",
-        f"templateImage={BRANCH_ICON}",
-    ]
-    print("|".join(params))
     shell_params = {
         "repo_name": repo_name,
-        "source_branch": branch["name"],
+        "source_branch": branch.name,
     }
     shell_params["fun"] = "merge_sandbox"
-    print(
-        f"----merge to sandbox |  shell={shell_file} | param1={encode_shell_params(shell_params)} | terminal=true"
-    )
+    add_action(item, "merge to sandbox", shell_params)
     shell_params["fun"] = "develop_pr"
     merge_develop_params = shell_params.copy()
     merge_develop_params["merge"] = True
-    print(
-        f"----merge to develop |  shell={shell_file} | param1={encode_shell_params(merge_develop_params)} | terminal=true"
-    )
+    add_action(item, "merge to develop", merge_develop_params)
     shell_params["fun"] = "develop_pr"
     pr_develop_params = shell_params.copy()
     pr_develop_params["merge"] = False
     pr_develop_params["close_source_branch"] = True
-    print(
-        f"----develop PR |  shell={shell_file} | param1={encode_shell_params(pr_develop_params)} | terminal=true"
-    )
-    if branch["name"] not in ["master", "develop", "main", "dev", "sandbox"]:
+    add_action(item, "develop PR", pr_develop_params)
+    if branch.name not in PROTECTED_BRANCHES:
         shell_params["fun"] = "delete_branch"
-        print(
-            f"----delete |  shell={shell_file} | param1={encode_shell_params(shell_params)} | terminal=true "
+        add_action(item, "delete", shell_params)
+    item.add(f"author: {branch.author}")
+    message = item.add("message")
+    for m in branch.message.split("\n"):
+        message.add(m)
+
+
+def render_batch(parent, repo):
+    """Actions over several branches, run as one batch by bitbucket_ops."""
+    batch = parent.add("batch")
+    names = [b.name for b in repo.branches if b.name not in PROTECTED_BRANCHES]
+    if names:
+        add_action(
+            batch,
+            f"merge {len(names)} listed branches to sandbox",
+            [
+                {"fun": "merge_sandbox", "repo_name": repo.name, "source_branch": name}
+                for name in names
+            ],
         )
-    print(f"----author: {branch['target']['author'].get('user', {}).get('nickname')}")
-    print(f"----message")
-    for m in branch["target"].get("message", "").split("\n"):
-        print(f"------{m}")
-
-
-for repo in data:
-    print("---")
-    repo_name = repo["repo"]
-    print(
-        f"{repo_name} | href=https://bitbucket.org/{WORKSPACE}/{repo_name} |color=#D0D0D0 | templateImage={REPO_ICON}"
+    add_action(
+        batch,
+        "delete merged branches",
+        [{"fun": "delete_merged_branches", "repo_name": repo.name}],
     )
-    print("---")
-    print("Branches")
-    print("---")
-    print(f"-- Total: {repo['branches_size']}")
-    for branch in repo["branches"]:
-        render_branch(branch, repo_name)
-    print("---")
-    print("Pull Requests")
-    render_new_pr(repo_name)
-    for pr in repo["pullrequests"]:
-        render_pr(pr, repo_name)
 
 
+with trace.span("render"):
+    for repo in data:
+        menu.separator()
+        repo_name = repo.name
+        menu.add(
+            repo_name,
+            href=f"https://bitbucket.org/{WORKSPACE}/{repo_name}",
+            color="#D0D0D0",
+            templateImage=REPO_ICON,
+        )
+        menu.separator()
+        menu.add("Branches")
+        branches = menu.separator()
+        branches.add(f" Total: {repo.branches_size}")
+        for branch in repo.branches:
+            render_branch(branches, branch, repo_name)
+        if repo.branches_size > len(repo.branches):
+            branches.add(
+                " more...", href=f"https://bitbucket.org/{WORKSPACE}/{repo_name}/branches/"
+            )
+        render_batch(branches, repo)
+        menu.separator()
+        menu.add("Pull Requests")
+        render_new_pr(menu, repo_name)
+        for pr in repo.pullrequests:
+            render_pr(menu, pr, repo_name)
+
+add_diagnostics(diagnostics, trace)
+menu.write()
+trace.write()
+
 # %%
@@ -0,0 +1,199 @@
+"""On-disk HTTP response cache for Bitbucket API reads.
+
+Each entry is one file: a JSON header line followed by the raw body.
+Entries younger than the TTL are served without touching the network,
+older ones are revalidated with If-None-Match / If-Modified-Since when the
+API sent validators, and the directory is kept under a size bound by
+evicting the least recently used files. A per-URL lock file, kept in
+a `locks` subdirectory apart from the entries, lets a process wait for
+another one already fetching the same URL and reuse its answer.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from stat import S_ISREG
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from xbar_state import STATE_DIR
+
+LOGGER = logging.getLogger("bitbucket cache")
+
+CACHE_DIR = STATE_DIR / "http"
+CACHE_TTL = float(os.environ.get("VAR_CACHE_TTL") or 120)
+CACHE_SIZE = int(float(os.environ.get("VAR_CACHE_SIZE_MB") or 50) * 1024 * 1024)
+
+# /2.0/repositories/{workspace}/{slug}
+REPO_PATH_DEPTH = 4
+LOCK_POLL = 0.05
+# a lock file untouched this long has no holder left and is removed by prune()
+LOCK_MAX_AGE = 24 * 60 * 60
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _repo_prefix(url):
+    """Entries of one repository share a file prefix so writes can drop them."""
+    path = url.split("://", 1)[-1].split("?", 1)[0]
+    segments = path.split("/")[1 : REPO_PATH_DEPTH + 1]
+    return _digest("/".join(segments))[:12]
+
+
+class CacheEntry:
+    def __init__(self, path, header, body):
+        self.path = path
+        self.header = header
+        self.body = body
+
+    @property
+    def age(self):
+        return time.time() - self.header["stored_at"]
+
+    def validators(self):
+        headers = {}
+        if self.header.get("etag"):
+            headers["If-None-Match"] = self.header["etag"]
+        if self.header.get("last_modified"):
+            headers["If-Modified-Since"] = self.header["last_modified"]
+        return headers
+
+    def to_response(self, request):
+        response = Response()
+        response.status_code = self.header["status"]
+        response.headers = CaseInsensitiveDict(self.header["headers"])
+        response._content = self.body
+        response.url = self.header["url"]
+        response.encoding = self.header.get("encoding")
+        response.reason = "OK"
+        response.request = request
+        response.from_cache = True
+        return response
+
+
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.directory = Path(directory)
+        self.locks = self.directory / "locks"
+        self.ttl = ttl
+        self.max_size = max_size
+        self.locks.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, request):
+        # the credentials are part of the key, one user never sees another's data
+        key = f"{request.headers.get('Authorization', '')} {request.url}"
+        return self.directory / f"{_repo_prefix(request.url)}-{_digest(key)}"
+
+    def get(self, request):
+        path = self._path(request)
+        try:
+            with path.open("rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+            # mtime doubles as the LRU clock
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, or pruned by another process after the read
+            return None
+        return CacheEntry(path, header, body)
+
+    @contextmanager
+    def lock(self, request, timeout):
+        """Hold the fetch lock of a URL; after `timeout` proceed without it."""
+        deadline = time.monotonic() + timeout
+        with (self.locks / self._path(request).name).open("a") as f:
+            # the mtime tells prune() the lock is still in use
+            os.utime(f.fileno())
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        break
+                    time.sleep(LOCK_POLL)
+            yield
+
+    def is_fresh(self, entry):
+        return entry.age < self.ttl
+
+    def put(self, request, response):
+        header = {
+            "url": response.url,
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "encoding": response.encoding,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored_at": time.time(),
+        }
+        self._write(self._path(request), header, response.content)
+
+    def refresh(self, entry, response):
+        """Record a 304: the stored body is valid for another TTL."""
+        entry.header["stored_at"] = time.time()
+        if response.headers.get("ETag"):
+            entry.header["etag"] = response.headers["ETag"]
+        self._write(entry.path, entry.header, entry.body)
+
+    def _write(self, path, header, body):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError:
+            LOGGER.warning("cache write failed: %s", path, exc_info=True)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def invalidate(self, url):
+        """Drop every entry of the repository `url` belongs to."""
+        for path in self.directory.glob(f"{_repo_prefix(url)}-*"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def prune(self):
+        """Evict least recently used entries until the cache fits max_size.
+
+        Lock files nobody used for LOCK_MAX_AGE are removed as well.
+        """
+        for path in self.locks.iterdir():
+            try:
+                if time.time() - path.stat().st_mtime > LOCK_MAX_AGE:
+                    path.unlink()
+            except OSError:
+                pass
+        entries = []
+        total = 0
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,64 @@
+#! /usr/local/bin/python3
+"""Keep one plugin's menu warm in the background.
+
+usage: bitbucket_daemon.py <name> <plugin path>
+
+The plugin is re-run in this process every VAR_DAEMON_INTERVAL seconds, so
+imports, the Cloud client and the pooled HTTP session stay warm, and its
+output is written as the snapshot the plugin entry point prints. The
+daemon exits when no plugin run has asked for the snapshot for a while,
+e.g. after xbar was quit, and is replaced when the settings change.
+"""
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+from bitbucket_ratelimit import RateLimiter
+from bitbucket_snapshot import DAEMON_INTERVAL, lock_daemon, render, write_snapshot
+from xbar_state import STATE_DIR
+
+log_file = Path(__file__).parent.parent / "logs/daemon.log"
+
+FORMAT = "%(asctime)-15s %(threadName)s %(filename)-15s:%(lineno)d %(levelname)-8s: %(message)s"
+logging.basicConfig(
+    filename=log_file.as_posix(), encoding="utf-8", level=logging.INFO, format=FORMAT
+)
+LOGGER = logging.getLogger("bitbucket daemon")
+
+IDLE_TIMEOUT = max(DAEMON_INTERVAL * 10, 600)
+# how long a new daemon waits for the one it replaces to exit
+REPLACE_TIMEOUT = 10
+
+
+def idle_for(name):
+    try:
+        return time.time() - (STATE_DIR / f"daemon-{name}.seen").stat().st_mtime
+    except OSError:
+        return 0
+
+
+def main(name, plugin_path):
+    lock = lock_daemon(name, timeout=REPLACE_TIMEOUT)
+    if lock is None:
+        LOGGER.info("%s daemon already running", name)
+        return
+    LOGGER.info("%s daemon started, pid %d", name, os.getpid())
+    limiter = RateLimiter()
+    while idle_for(name) < IDLE_TIMEOUT:
+        started = time.monotonic()
+        try:
+            write_snapshot(name, render(plugin_path))
+        except Exception:
+            # keep serving the previous snapshot
+            LOGGER.exception("%s render failed", name)
+        LOGGER.info("%s rendered in %.2fs", name, time.monotonic() - started)
+        # poll less often while the API quota is tight
+        interval = DAEMON_INTERVAL * limiter.backoff()
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+    LOGGER.info("%s daemon idle, exiting", name)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
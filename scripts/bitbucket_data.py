@@ -0,0 +1,383 @@
+"""Workspace data shared by the pr and pipeline plugins.
+
+One refresh walks workspace -> recently updated repositories -> open
+pull requests, branches, recent pipelines and their steps, and stores
+the result as a JSON snapshot under the state directory. Both plugins
+are views over that snapshot: whichever runs first in a tick refreshes
+it, the other one waits on the refresh lock and reads the result.
+
+The snapshot holds slim records (bitbucket_records) rather than API
+payloads, so reading it needs neither atlassian nor requests, and a
+refresh lists the repositories itself, without the atlassian client.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import chain, islice
+
+from bitbucket_query import QueryError, all_of, compare, none_of, validate
+from bitbucket_ratelimit import RateLimited
+from bitbucket_records import Branch, Pipeline, PullRequest, Repo, Step
+from bitbucket_trace import span
+from xbar_state import STATE_DIR, load_state, save_state
+
+LOGGER = logging.getLogger("bitbucket data")
+
+# settings that shape the shared refresh; each is declared by the one
+# plugin it belongs to, the other plugin reads the value it last ran with
+SHARED_SETTINGS = (
+    "VAR_MY_NICKNAME",
+    "VAR_MAX_BRANCHES",
+    "VAR_REPO_DAYS",
+    "VAR_BRANCH_DAYS",
+    "VAR_ONLY_MY_PRS",
+    "VAR_PROTECTED_BRANCHES",
+    "VAR_HIDE_PROTECTED",
+    "VAR_PR_FILTER",
+    "VAR_BRANCH_FILTER",
+    "VAR_PIPELINE_HOURS",
+)
+SETTINGS_STATE = "bitbucket-settings.json"
+
+
+def _shared_settings():
+    """SHARED_SETTINGS from the environment when this plugin declares them, else stored."""
+    stored = load_state(SETTINGS_STATE) or {}
+    declared = {name: os.environ[name] for name in SHARED_SETTINGS if name in os.environ}
+    if any(stored.get(name) != value for name, value in declared.items()):
+        save_state(SETTINGS_STATE, {**stored, **declared})
+    return {**stored, **declared}
+
+
+_settings = _shared_settings()
+
+# a little under the plugins' one minute tick, so each tick refreshes once
+DATA_TTL = float(os.environ.get("VAR_DATA_TTL") or 50)
+CONCURRENCY = max(1, int(os.environ.get("VAR_CONCURRENCY") or 8))
+MAX_BRANCHES = max(0, int(_settings.get("VAR_MAX_BRANCHES") or 20)) or None
+MY_NICKNAME = _settings.get("VAR_MY_NICKNAME")
+# recency windows, 0 turns the branch one off
+REPO_DAYS = float(_settings.get("VAR_REPO_DAYS") or 7)
+BRANCH_DAYS = float(_settings.get("VAR_BRANCH_DAYS") or 0)
+PIPELINE_HOURS = float(_settings.get("VAR_PIPELINE_HOURS") or 2)
+ONLY_MY_PRS = _settings.get("VAR_ONLY_MY_PRS", "false").lower() == "true"
+PROTECTED_BRANCHES = tuple(
+    name.strip()
+    for name in (
+        _settings.get("VAR_PROTECTED_BRANCHES") or "master,develop,main,dev,sandbox"
+    ).split(",")
+    if name.strip()
+)
+HIDE_PROTECTED = _settings.get("VAR_HIDE_PROTECTED", "false").lower() == "true"
+PR_FILTER = _settings.get("VAR_PR_FILTER")
+BRANCH_FILTER = _settings.get("VAR_BRANCH_FILTER")
+# the largest pagelen bitbucket accepts on refs/branches
+MAX_PAGELEN = 100
+# bumped when the record layout changes, older snapshots are refetched
+SNAPSHOT_VERSION = 3
+
+
+class FetchError(Exception):
+    """The API refused or failed a request of the refresh."""
+
+
+class Queries:
+    """The `q=`/`sort=` parameters of one refresh, built from the xbar vars.
+
+    Raises QueryError for a setting the API would reject.
+    """
+
+    def __init__(self, now=None):
+        now = now or datetime.now(timezone.utc)
+        for name, days in (("VAR_REPO_DAYS", REPO_DAYS), ("VAR_BRANCH_DAYS", BRANCH_DAYS)):
+            if days < 0:
+                raise QueryError(f"{name} must not be negative")
+        if PIPELINE_HOURS <= 0:
+            raise QueryError("VAR_PIPELINE_HOURS must be positive")
+        if ONLY_MY_PRS and not MY_NICKNAME:
+            raise QueryError("VAR_ONLY_MY_PRS needs VAR_MY_NICKNAME")
+        try:
+            pr_filter = validate(PR_FILTER)
+        except QueryError as e:
+            raise QueryError(f"VAR_PR_FILTER: {e}") from None
+        try:
+            branch_filter = validate(BRANCH_FILTER)
+        except QueryError as e:
+            raise QueryError(f"VAR_BRANCH_FILTER: {e}") from None
+
+        self.repo_days = REPO_DAYS
+        self.pipelines_since = now - timedelta(hours=PIPELINE_HOURS)
+        self.pullrequests = all_of(
+            compare("state", "=", "OPEN"),
+            compare("author.nickname", "=", MY_NICKNAME) if ONLY_MY_PRS else None,
+            pr_filter,
+        )
+        # whole hours keep the query, and so the cached response, stable
+        branches_since = (now - timedelta(days=BRANCH_DAYS)).replace(
+            minute=0, second=0, microsecond=0
+        )
+        self.branches = all_of(
+            compare("target.date", ">", branches_since) if BRANCH_DAYS else None,
+            none_of("name", PROTECTED_BRANCHES) if HIDE_PROTECTED else None,
+            branch_filter,
+        )
+        # newest commit first, so MAX_BRANCHES keeps the active ones
+        self.branch_sort = "-target.date"
+
+    def key(self):
+        """Digest of the settings; snapshots are only shared between equal ones.
+
+        Both plugins read the settings hashed here from SHARED_SETTINGS,
+        so they share one refresh whatever the values.
+        """
+        settings = [
+            REPO_DAYS,
+            BRANCH_DAYS,
+            PIPELINE_HOURS,
+            MAX_BRANCHES,
+            ONLY_MY_PRS and MY_NICKNAME,
+            HIDE_PROTECTED and PROTECTED_BRANCHES,
+            PR_FILTER,
+            BRANCH_FILTER,
+        ]
+        return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()[:8]
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _snapshot_name(workspace, queries):
+    return f"data-{workspace}-{queries.key()}.json"
+
+
+def _fresh(data, ttl):
+    return (
+        data is not None
+        and data.get("version") == SNAPSHOT_VERSION
+        and time.time() - data["created_at"] < ttl
+    )
+
+
+@contextmanager
+def _refresh_lock(workspace):
+    """Block while another process refreshes the same workspace."""
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    with (STATE_DIR / f"data-{workspace}.lock").open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def expire_workspace(workspace):
+    """Make the next run refresh the snapshots of `workspace`, e.g. after a merge.
+
+    They are aged rather than removed, so they remain the fallback when
+    the refresh fails.
+    """
+    with _refresh_lock(workspace):
+        for path in STATE_DIR.glob(f"data-{workspace}-*.json"):
+            data = load_state(path.name)
+            if data is not None:
+                data["created_at"] = 0
+                save_state(path.name, data)
+
+
+def load_workspace(username, password, workspace, ttl=DATA_TTL):
+    """Return the `Repo` records of the workspace, refreshing them when older than `ttl`.
+
+    Without API budget, or when the API fails, the previous snapshot is
+    kept, however old. Raises QueryError when the filter settings are
+    invalid, RateLimited when there is no budget and FetchError when the
+    API refuses a request, e.g. a filter it does not accept, and there
+    is no snapshot yet.
+    """
+    queries = Queries()
+    name = _snapshot_name(workspace, queries)
+    data = load_state(name)
+    if not _fresh(data, ttl):
+        with _refresh_lock(workspace):
+            # the refresh we waited for may have just written it
+            data = load_state(name)
+            if not _fresh(data, ttl):
+                try:
+                    repos = fetch_workspace(username, password, workspace, queries)
+                except (RateLimited, FetchError) as e:
+                    if data is None or data.get("version") != SNAPSHOT_VERSION:
+                        raise
+                    LOGGER.warning("%s, keeping the previous snapshot", e)
+                    return [Repo.from_json(repo) for repo in data["repos"]]
+                data = {
+                    "version": SNAPSHOT_VERSION,
+                    "workspace": workspace,
+                    "created_at": time.time(),
+                    "repos": [repo.to_json() for repo in repos],
+                }
+                save_state(name, data)
+                return repos
+    return [Repo.from_json(repo) for repo in data["repos"]]
+
+
+class Fetcher:
+    def __init__(self, session, api_url, workspace, queries):
+        self.session = session
+        self.base = f"{api_url}2.0/repositories/{workspace}"
+        self.queries = queries
+
+    def paginate(self, url, params=None):
+        """Yield API pages one at a time, following `next` only when asked for more."""
+        while url:
+            res = self.session.get(url, params=params)
+            res.raise_for_status()
+            page = res.json()
+            yield page
+            # `next` already carries the query string
+            url, params = page.get("next"), None
+
+    def pullrequests(self, slug):
+        url = f"{self.base}/{slug}/pullrequests"
+        params = {
+            "q": self.queries.pullrequests,
+            "sort": "-created_on",
+            "fields": PullRequest.FIELDS,
+        }
+        return [
+            PullRequest.from_api(pr)
+            for page in self.paginate(url, params)
+            for pr in page["values"]
+        ]
+
+    def branches(self, slug, limit=MAX_BRANCHES):
+        url = f"{self.base}/{slug}/refs/branches"
+        params = {
+            "fields": Branch.FIELDS,
+            "pagelen": min(MAX_PAGELEN, limit or MAX_PAGELEN),
+            "sort": self.queries.branch_sort,
+            "q": self.queries.branches,
+        }
+        pages = self.paginate(url, params)
+        first = next(pages, None)
+        if first is None:
+            return [], 0
+        values = chain.from_iterable(page["values"] for page in chain([first], pages))
+        return [Branch.from_api(b) for b in islice(values, limit)], first["size"]
+
+    def pipelines(self, slug):
+        """Pipelines created in the recency window, newest first."""
+        url = f"{self.base}/{slug}/pipelines/"
+        since = self.queries.pipelines_since
+        recent = []
+        # the pipelines endpoint takes no q=, it is read newest first up to
+        # the window; it is paged by number, without `next` links
+        for page in range(1, 100):
+            params = {"sort": "-created_on", "page": page, "fields": Pipeline.FIELDS}
+            res = self.session.get(url, params=params)
+            res.raise_for_status()
+            body = res.json()
+            values = body.get("values", [])
+            for pipeline in values:
+                if parse_time(pipeline["created_on"]) < since:
+                    return recent
+                recent.append(Pipeline.from_api(pipeline))
+            if not values or page * body.get("pagelen", len(values)) >= body.get("size", 0):
+                break
+        return recent
+
+    def steps(self, slug, pipeline):
+        url = f"{self.base}/{slug}/pipelines/{pipeline.uuid}/steps/"
+        params = {"fields": Step.FIELDS}
+        return [
+            Step.from_api(step)
+            for page in self.paginate(url, params)
+            for step in page["values"]
+        ]
+
+    def repo(self, repo):
+        branches, branches_size = self.branches(repo.slug)
+        return Repo(
+            repo.name,
+            repo.slug,
+            self.pullrequests(repo.slug),
+            branches,
+            branches_size,
+            self.pipelines(repo.slug),
+        )
+
+
+def _error_message(error):
+    """The API's own message of a refused request, else its status or the exception."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return str(error) or type(error).__name__
+    try:
+        message = response.json()["error"]["message"]
+    except (KeyError, TypeError, ValueError):
+        message = response.reason
+    return f"{response.status_code} {message}"
+
+
+def fetch_workspace(username, password, workspace, queries):
+    """Fetch the `Repo` records; raises FetchError when a request fails."""
+    # only a refresh pays for requests
+    from requests import RequestException
+
+    try:
+        return _fetch_workspace(username, password, workspace, queries)
+    except RequestException as e:
+        raise FetchError(_error_message(e)) from e
+
+
+def _fetch_workspace(username, password, workspace, queries):
+    from requests import HTTPError, RequestException
+
+    from bitbucket_http import API_URL, get_session
+    from bitbucket_repos import discover_repositories, forget_repositories
+
+    fetcher = Fetcher(get_session(username, password), API_URL, workspace, queries)
+    with span("discover"):
+        repos = discover_repositories(fetcher, workspace, days=queries.repo_days)
+
+    def fetch_repo(repo):
+        # one failing repository only costs its own entry
+        try:
+            return fetcher.repo(repo)
+        except RequestException as e:
+            LOGGER.warning("%s skipped: %s", repo.full_name, _error_message(e))
+            return e
+
+    def fetch_steps(args):
+        try:
+            return fetcher.steps(*args)
+        except RequestException as e:
+            LOGGER.warning("steps of %s skipped: %s", args[1].uuid, _error_message(e))
+            return []
+
+    # map() keeps the -updated_on order of the listing
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        with span("fetch"):
+            results = list(executor.map(fetch_repo, repos))
+        errors = [e for e in results if isinstance(e, Exception)]
+        if errors and len(errors) == len(results):
+            # nothing to show; a refused filter or an outage, not a bad repository
+            raise errors[0]
+        # deleted, renamed or no longer readable: listed again only when updated
+        gone = [
+            repo.full_name
+            for repo, e in zip(repos, results)
+            if isinstance(e, HTTPError) and e.response.status_code in (403, 404)
+        ]
+        if gone:
+            forget_repositories(workspace, queries.repo_days, gone)
+        data = [repo for repo in results if not isinstance(repo, Exception)]
+        pipelines = [(repo.slug, p) for repo in data for p in repo.pipelines]
+        # steps of every recent pipeline across all repositories at once
+        with span("steps"):
+            steps = executor.map(fetch_steps, pipelines)
+            for (_, pipeline), pipeline_steps in zip(pipelines, steps):
+                pipeline.steps = pipeline_steps
+    return data
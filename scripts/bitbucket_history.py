@@ -0,0 +1,179 @@
+"""Local history of finished pipelines and steps, for duration statistics.
+
+Every refresh adds the finished pipelines and steps of the snapshot to
+an SQLite database under the state directory. Finished runs never change,
+so rows are only inserted, once each, keyed by uuid; the pipelines in
+the recency window make the whole fill a single small transaction. The
+tables are indexed on (repo, target, created_on) and (repo, step name,
+created_on), which is how the statistics read them.
+"""
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+from xbar_state import STATE_DIR
+
+# results of a run that completed; PENDING, IN_PROGRESS, PAUSED... are still going
+FINISHED = ("SUCCESSFUL", "FAILED", "ERROR", "STOPPED", "EXPIRED")
+# durations of other results say little about the next run
+MEASURED = "SUCCESSFUL"
+# newest runs per repository, target or step the statistics look at
+SAMPLES = 50
+# fewer runs than this on a target fall back to the whole repository
+MIN_SAMPLES = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pipelines (
+    uuid TEXT PRIMARY KEY,
+    repo TEXT NOT NULL,
+    target TEXT NOT NULL,
+    build_number INTEGER,
+    created_on TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS pipelines_repo_target
+    ON pipelines (repo, target, created_on);
+CREATE TABLE IF NOT EXISTS steps (
+    uuid TEXT PRIMARY KEY,
+    pipeline TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    target TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created_on TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS steps_repo_name
+    ON steps (repo, name, created_on);
+"""
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`, None when empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def elapsed(step, now=None):
+    """Seconds `step` has run; the API leaves duration_in_seconds empty until it ends."""
+    if step.duration_in_seconds is not None:
+        return step.duration_in_seconds
+    if not step.started_on:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    started = datetime.fromisoformat(step.started_on.replace("Z", "+00:00"))
+    return max(0, (now - started).total_seconds())
+
+
+class History:
+    def __init__(self, path=None):
+        path = path or STATE_DIR / "pipelines.sqlite"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10)
+        # readers do not wait on the writer of another plugin run
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, repos):
+        """Add the finished pipelines and steps of `repos`; return the rows inserted."""
+        pipelines = []
+        steps = []
+        for repo in repos:
+            for pipeline in repo.pipelines:
+                if pipeline.status in FINISHED:
+                    pipelines.append(
+                        (
+                            pipeline.uuid,
+                            repo.name,
+                            pipeline.target_name,
+                            pipeline.build_number,
+                            pipeline.created_on,
+                            pipeline.status,
+                            pipeline.build_seconds_used,
+                        )
+                    )
+                # a step can finish while its pipeline still runs
+                steps.extend(
+                    (
+                        step.uuid,
+                        pipeline.uuid,
+                        repo.name,
+                        pipeline.target_name,
+                        step.name or "",
+                        pipeline.created_on,
+                        step.status,
+                        step.duration_in_seconds,
+                    )
+                    for step in pipeline.steps
+                    if step.status in FINISHED
+                )
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO pipelines VALUES (?, ?, ?, ?, ?, ?, ?)", pipelines
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", steps
+            )
+            return self.db.total_changes - before
+
+    def _durations(self, sql, args):
+        with closing(self.db.execute(sql, args)) as cursor:
+            return [duration for duration, in cursor]
+
+    def pipeline_durations(self, repo, target=None):
+        """Newest successful pipeline durations of `repo`, or of one target in it."""
+        sql = "SELECT duration FROM pipelines WHERE repo = ? AND status = ?"
+        args = [repo, MEASURED]
+        if target is not None:
+            sql += " AND target = ?"
+            args.append(target)
+        sql += " AND duration IS NOT NULL ORDER BY created_on DESC LIMIT ?"
+        return self._durations(sql, args + [SAMPLES])
+
+    def step_durations(self, repo, name, target=None):
+        """Newest successful durations of step `name`, on `target` when it has enough runs."""
+        sql = (
+            "SELECT duration FROM steps WHERE repo = ? AND name = ? AND status = ?"
+            " AND duration IS NOT NULL{} ORDER BY created_on DESC LIMIT ?"
+        )
+        if target is not None:
+            durations = self._durations(
+                sql.format(" AND target = ?"), (repo, name, MEASURED, target, SAMPLES)
+            )
+            if len(durations) >= MIN_SAMPLES:
+                return durations
+        return self._durations(sql.format(""), (repo, name, MEASURED, SAMPLES))
+
+    def step_stats(self, repo):
+        """{step name: (p50, p95, runs)} over the newest successful runs of each step."""
+        sql = """
+            SELECT name, duration FROM (
+                SELECT name, duration, ROW_NUMBER() OVER (
+                    PARTITION BY name ORDER BY created_on DESC
+                ) AS n
+                FROM steps
+                WHERE repo = ? AND status = ? AND duration IS NOT NULL
+            ) WHERE n <= ?
+        """
+        by_name = {}
+        with closing(self.db.execute(sql, (repo, MEASURED, SAMPLES))) as cursor:
+            for name, duration in cursor:
+                by_name.setdefault(name, []).append(duration)
+        return {
+            name: (percentile(durations, 50), percentile(durations, 95), len(durations))
+            for name, durations in sorted(by_name.items())
+        }
+
+    def eta(self, repo, target, step, now=None):
+        """(seconds left, median duration) of a running step, (None, None) without history."""
+        p50 = percentile(self.step_durations(repo, step.name or "", target), 50)
+        if p50 is None:
+            return None, None
+        return max(0, p50 - elapsed(step, now)), p50
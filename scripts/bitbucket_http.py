@@ -0,0 +1,239 @@
+"""Shared, pooled HTTP session for the bitbucket plugins and scripts.
+
+Raw REST calls and the atlassian `Cloud` client go through the same
+keep-alive session so one refresh reuses a handful of TLS connections.
+GET responses are served from / stored in the on-disk `ResponseCache`,
+network requests are paced by the cross-process `RateLimiter`, and every
+response is recorded in the refresh trace.
+
+Every attempt against the API host takes a token, urllib3's retries
+included; requests to other hosts, like the S3 redirects of pipeline
+logs, do not count against the API quota and skip the limiter.
+"""
+import copy
+import os
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bitbucket_cache import CACHE_TTL, ResponseCache
+from bitbucket_ratelimit import RateLimited, RateLimiter
+from bitbucket_trace import response_hook
+
+# overridable so the benchmark can point the plugins at its stand-in server
+API_URL = os.environ.get("BITBUCKET_API_URL") or "https://api.bitbucket.org/"
+API_HOST = urlsplit(API_URL).hostname
+
+POOL_SIZE = int(os.environ.get("VAR_POOL_SIZE") or 10)
+TIMEOUT = float(os.environ.get("VAR_TIMEOUT") or 15)
+RETRIES = int(os.environ.get("VAR_RETRIES") or 3)
+# a 429 is not retried here: the limiter sees it and holds back every process
+RETRY_STATUS = (500, 502, 503, 504)
+
+_session = None
+_lock = threading.Lock()
+
+
+def metered(url):
+    """True when a request to `url` counts against the API rate limit."""
+    return urlsplit(url).hostname == API_HOST
+
+
+class LimitedRetry(Retry):
+    """Retry that takes a rate limiter token before each retried attempt.
+
+    urllib3 retries inside a single adapter send(), which only took the
+    token of the first attempt.
+    """
+
+    def __init__(self, *args, limiter=None, interactive=False, timeout=TIMEOUT, **kwargs):
+        self.limiter = limiter
+        self.interactive = interactive
+        self.timeout = timeout
+        self.host = None
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.limiter = self.limiter
+        retry.interactive = self.interactive
+        retry.timeout = self.timeout
+        retry.host = self.host
+        return retry
+
+    def increment(self, method=None, url=None, *args, _pool=None, **kwargs):
+        retry = super().increment(method, url, *args, _pool=_pool, **kwargs)
+        if _pool is not None:
+            retry.host = _pool.host
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.limiter is None or self.host != API_HOST:
+            return
+        if not self.limiter.acquire(self.interactive, timeout=self.timeout):
+            raise RateLimited(f"no API budget to retry a request to {self.host}")
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout, an optional response cache
+    and the shared rate limit.
+
+    Identical GETs in flight at the same time are sent once: other threads
+    wait for the first one and get a copy of its response, other processes
+    wait on the cache's fetch lock and read the entry it stored.
+    """
+
+    def __init__(
+        self, *args, timeout=TIMEOUT, cache=None, limiter=None, interactive=False, **kwargs
+    ):
+        self.timeout = timeout
+        self.cache = cache
+        self.limiter = limiter
+        self.interactive = interactive
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if request.method != "GET" or kwargs.get("stream"):
+            if self.cache is not None and request.method != "GET":
+                self.cache.invalidate(request.url)
+            return self._send(request, **kwargs)
+        key = (request.headers.get("Authorization"), request.url)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            response = copy.copy(future.result())
+            response.request = request
+            return response
+        try:
+            response = self._cached_send(request, **kwargs)
+            # read the body once for every waiter
+            response.content
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _send(self, request, **kwargs):
+        """Send over the network once the rate limiter lets it through.
+
+        Raises RateLimited when no budget comes within the timeout.
+        """
+        if self.limiter is None or not metered(request.url):
+            return super().send(request, **kwargs)
+        if not self.limiter.acquire(self.interactive, timeout=self.timeout):
+            raise RateLimited(f"no API budget for {request.method} {request.url}")
+        response = super().send(request, **kwargs)
+        self.limiter.update(response)
+        return response
+
+    def _cached_send(self, request, **kwargs):
+        if self.cache is None:
+            return self._send(request, **kwargs)
+        entry = self.cache.get(request)
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                return entry.to_response(request)
+            if self.limiter is not None and self.limiter.throttled(self.interactive):
+                # over budget, a stale answer beats waiting for a 429
+                return entry.to_response(request)
+        with self.cache.lock(request, self.timeout):
+            # another process may have stored it while this one waited
+            latest = self.cache.get(request)
+            if latest is not None:
+                if self.cache.is_fresh(latest):
+                    return latest.to_response(request)
+                entry = latest
+            if entry is not None:
+                request.headers.update(entry.validators())
+            try:
+                response = self._send(request, **kwargs)
+            except RateLimited:
+                if entry is None:
+                    raise
+                return entry.to_response(request)
+            if response.status_code == 304 and entry is not None:
+                self.cache.refresh(entry, response)
+                cached = entry.to_response(request)
+                cached.revalidated = True
+                return cached
+            if response.status_code == 200:
+                self.cache.put(request, response)
+            return response
+
+
+def make_session(username, password, pool_size=POOL_SIZE, timeout=TIMEOUT, interactive=False):
+    cache = None
+    if CACHE_TTL > 0:
+        cache = ResponseCache()
+        cache.prune()
+    session = requests.Session()
+    session.auth = (username, password)
+    session.headers.update({"Accept": "application/json"})
+    session.hooks["response"].append(response_hook)
+    limiter = RateLimiter()
+    # only idempotent methods are retried, on server errors
+    retry = LimitedRetry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+        limiter=limiter,
+        interactive=interactive,
+        timeout=timeout,
+    )
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+        timeout=timeout,
+        cache=cache,
+        limiter=limiter,
+        interactive=interactive,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(username, password, interactive=False):
+    """Return the process wide session, creating it on first use.
+
+    `interactive` sessions (user clicks) may use the rate limit reserve
+    background refreshes leave untouched.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = make_session(username, password, interactive=interactive)
+        return _session
+
+
+def make_cloud(username, password, interactive=False):
+    """Build a `Cloud` client that shares the pooled session."""
+    # atlassian is the slowest import of a refresh, only pay for it when used
+    from atlassian.bitbucket.cloud import Cloud
+
+    return Cloud(
+        url=API_URL,
+        username=username,
+        password=password,
+        cloud=True,
+        session=get_session(username, password, interactive),
+        timeout=TIMEOUT,
+    )
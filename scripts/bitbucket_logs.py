@@ -0,0 +1,105 @@
+"""Incremental, tail-only reader for pipeline step logs.
+
+The first read of a log requests only its last `tail_bytes` (HTTP suffix
+range). The byte offset reached and the last lines are kept in a state
+file keyed by repo/build_number/step uuid, so the next refresh asks only
+for the bytes appended since. Memory and transfer per refresh stay
+constant however long the build log grows. A read that fails leaves the
+stored entry as it was; the cached tail is shown with an error line.
+"""
+import logging
+import os
+from collections import deque
+
+from bitbucket_ratelimit import RateLimited
+from xbar_state import load_state, save_state
+
+LOGGER = logging.getLogger("bitbucket logs")
+
+TAIL_BYTES = int(float(os.environ.get("VAR_LOG_TAIL_KB") or 16) * 1024)
+TAIL_LINES = int(os.environ.get("VAR_LOG_LINES") or 30)
+CHUNK_SIZE = 8192
+
+
+def log_key(repo_name, build_number, step_uuid):
+    return f"{repo_name}/{build_number}/{step_uuid}"
+
+
+def _range_start(res):
+    # Content-Range: bytes 100-199/1000
+    content_range = res.headers.get("Content-Range", "")
+    try:
+        return int(content_range.split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+class LogTails:
+    """Offsets and cached tails of step logs, persisted between refreshes."""
+
+    def __init__(self, name="logs.json", tail_bytes=TAIL_BYTES, max_lines=TAIL_LINES):
+        self.name = name
+        self.tail_bytes = tail_bytes
+        self.max_lines = max_lines
+        self.entries = load_state(name) or {}
+
+    def tail(self, session, key, url):
+        """Return the last lines of the log at `url` as a deque of str."""
+        # only a running step gets here, the others skip the requests import
+        from requests import RequestException
+
+        try:
+            return self._read(session, key, url)
+        except (RequestException, RateLimited) as e:
+            LOGGER.warning("log read failed: %s: %s", key, e)
+            entry = self.entries.get(key)
+            lines = deque(entry["lines"] if entry else (), maxlen=self.max_lines + 1)
+            lines.append(f"[log unavailable: {e}]")
+            return lines
+
+    def _read(self, session, key, url):
+        entry = self.entries.get(key)
+        lines = deque(entry["lines"] if entry else (), maxlen=self.max_lines)
+        if entry is None:
+            byte_range = f"bytes=-{self.tail_bytes}"
+        else:
+            byte_range = f"bytes={entry['offset']}-"
+        headers = {"Accept": "application/octet-stream", "Range": byte_range}
+        with session.get(url, headers=headers, stream=True) as res:
+            # 404: no log yet, 416: nothing new since the stored offset
+            if res.status_code in (404, 416):
+                return lines
+            res.raise_for_status()
+            if res.status_code == 206:
+                offset = _range_start(res)
+            else:
+                # the range was ignored, the whole log is read again
+                offset = 0
+                lines.clear()
+            # a tail read starting mid-file most likely cuts the first line
+            skip = entry is None and offset > 0
+            buffer = b""
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                buffer += chunk
+                *complete, buffer = buffer.split(b"\n")
+                for line in complete:
+                    offset += len(line) + 1
+                    if skip:
+                        skip = False
+                        continue
+                    lines.append(line.decode("utf-8", errors="replace"))
+        # an unterminated last line is fetched again on the next refresh
+        self.entries[key] = {"offset": offset, "lines": list(lines)}
+        return lines
+
+    def retain(self, builds):
+        """Evict entries whose (repo_name, build_number) is not in `builds`."""
+        active = {f"{repo_name}/{build_number}/" for repo_name, build_number in builds}
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items()
+            if key[: key.rindex("/") + 1] in active
+        }
+
+    def save(self):
+        save_state(self.name, self.entries)
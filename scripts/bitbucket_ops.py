@@ -1,15 +1,32 @@
 #! /usr/local/bin/python3
+"""Actions behind the plugin menu items.
+
+usage: bitbucket_ops.py <base64 JSON>
+
+The payload is one operation, {"fun": "merge_pr", "repo_name": ..., ...},
+or a list of them. A list runs as a batch: operations go in parallel
+over the shared session and each one's result is reported, so e.g.
+cleaning up a dozen branches takes one terminal window. Operations that
+write into the same destination branch of a repository, pull request
+merges and declines included, run one after another, in the order given,
+as parallel merges into it would race. Expanding
+operations such as delete_merged_branches turn into one operation per
+branch before the batch runs. After a successful write the shared
+workspace snapshot is expired, so the next refresh shows the change.
+"""
 import json
 import logging
 import os
 import sys
 from base64 import b64decode
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
 
-import requests
-from atlassian import Bitbucket
-from atlassian.bitbucket.cloud import Cloud
+from bitbucket_data import PROTECTED_BRANCHES, expire_workspace
+from bitbucket_http import API_URL, get_session, make_cloud
+from bitbucket_query import all_of, compare
 
 log_file = Path(__file__).parent.parent / "logs/script.log"
 
@@ -21,6 +38,9 @@ LOGGER.info(sys.argv)
 USERNAME = os.environ.get("VAR_USERNAME")
 PASSWORD = os.environ.get("VAR_PASSWORD")
 WORKSPACE = os.environ.get("VAR_WORKSPACE")
+CONCURRENCY = max(1, int(os.environ.get("VAR_CONCURRENCY") or 8))
+# how far back delete_merged_branches looks for merged pull requests
+MERGED_DAYS = 30
 
 LOGGER.info("start create_pr, %s", USERNAME)
 
@@ -30,53 +50,62 @@ def decode_params():
     return json.loads(b64decode(params.encode("utf-8")))
 
 
-cloud = Cloud(
-    url="https://api.bitbucket.org/",
-    username=USERNAME,
-    password=PASSWORD,
-    cloud=True,
-)
+# clicks go ahead of the background refreshes in the shared rate limit
+session = get_session(USERNAME, PASSWORD, interactive=True)
 
 
 def _get_reviews():
     ids = os.environ.get("VAR_REVIEWERS")
     if ids is None:
-        LOGGER.error("Missing Reviews ID (UUID)")
-        sys.exit(-1)
+        raise ValueError("Missing Reviews ID (UUID)")
     return [{"uuid": uuid} for uuid in ids.split(",")]
 
 
 def _create_branch(repo, name, parent):
-    url = f"https://api.bitbucket.org/2.0/repositories/{WORKSPACE}/{repo}/refs/branches"
-    res = requests.post(
+    url = f"{API_URL}2.0/repositories/{WORKSPACE}/{repo}/refs/branches"
+    res = session.post(
         url,
         data=json.dumps({"name": name, "target": {"hash": parent}}),
         headers={"Content-Type": "application/json"},
-        auth=(USERNAME, PASSWORD),
     )
-    print(res.json())
+    res.raise_for_status()
+    LOGGER.info(res.json())
 
 
 def _delete_branch(repo, name):
-    url = f"https://api.bitbucket.org/2.0/repositories/{WORKSPACE}/{repo}/refs/branches/{name}"
-    requests.delete(
-        url,
-        auth=(USERNAME, PASSWORD),
-    )
+    url = f"{API_URL}2.0/repositories/{WORKSPACE}/{repo}/refs/branches/{name}"
+    session.delete(url).raise_for_status()
     LOGGER.info("delete branch OK")
 
 
-params = decode_params()
-
-LOGGER.info(params)
+def _paginate(url, params):
+    while url:
+        page = session.get(url, params=params).json()
+        yield from page.get("values", [])
+        url, params = page.get("next"), None
 
 
 now = datetime.now()
-workspace = cloud.workspaces.get(WORKSPACE)
-repo = workspace.repositories.get(params["repo_name"])
 
 
-def release_pr():
+@lru_cache(maxsize=None)
+def _cloud():
+    # the Cloud client is only built for the actions that use it
+    return make_cloud(USERNAME, PASSWORD, interactive=True)
+
+
+@lru_cache(maxsize=None)
+def get_repo(repo_name):
+    return _cloud().repositories.get(WORKSPACE, repo_name)
+
+
+def get_pr(params):
+    """Fetch the pull request by id, no listing involved."""
+    return get_repo(params["repo_name"]).pullrequests.get(str(params["pr_id"]))
+
+
+def release_pr(params):
+    repo = get_repo(params["repo_name"])
     branch_name = f"release/{now.strftime('%Y%m%d')}"
     _create_branch(
         params["repo_name"], branch_name, params.get("source_branch", "develop")
@@ -88,9 +117,11 @@ def release_pr():
         close_source_branch=True,
     )
     LOGGER.info("Release PullRequest Created, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-def hotfix_pr():
+def hotfix_pr(params):
+    repo = get_repo(params["repo_name"])
     branch_name = f"hotfix/{now.strftime('%Y%m%d')}"
     _create_branch(
         params["repo_name"], branch_name, params.get("source_branch", "develop")
@@ -102,9 +133,11 @@ def hotfix_pr():
         close_source_branch=True,
     )
     LOGGER.info("Hotfix PullRequest Created, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-def merge_sandbox():
+def merge_sandbox(params):
+    repo = get_repo(params["repo_name"])
     pr = repo.pullrequests.create(
         title=f"sandbox-{now.strftime('%Y%m%d')}",
         source_branch=params.get("source_branch", "develop"),
@@ -113,9 +146,11 @@ def merge_sandbox():
     )
     pr.merge()
     LOGGER.info("Merge Sandbox Success, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-def develop_pr():
+def develop_pr(params):
+    repo = get_repo(params["repo_name"])
     pr = repo.pullrequests.create(
         title=params.get("source_branch", f"develop-{now.strftime('%Y%m%d')}"),
         source_branch=params.get("source_branch"),
@@ -125,30 +160,33 @@ def develop_pr():
     if params.get("merge", False):
         pr.merge()
     LOGGER.info("Develop PullRequest Created, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-def delete_branch():
+def delete_branch(params):
     source_branch = params.get("source_branch")
+    if source_branch in PROTECTED_BRANCHES:
+        raise ValueError(f"{source_branch} is protected")
     _delete_branch(params["repo_name"], source_branch)
+    return "deleted"
 
 
-def merge_pr():
-    pr_id = params.get("pr_id")
-    pr = next(repo.pullrequests.each(q=f"id={pr_id}"))
+def merge_pr(params):
+    pr = get_pr(params)
     pr.merge()
     LOGGER.info("PullRequest Merge Success, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-def decline_pr():
-    pr_id = params.get("pr_id")
-    pr = next(repo.pullrequests.each(q=f"id={pr_id}"))
+def decline_pr(params):
+    pr = get_pr(params)
     pr.decline()
     LOGGER.info("PullRequest Decline Success")
+    return pr.get_link("html")
 
 
-def pr_add_review():
-    pr_id = params.get("pr_id")
-    pr = next(repo.pullrequests.each(q=f"id={pr_id}"))
+def pr_add_review(params):
+    pr = get_pr(params)
     pr.put(
         None,
         data={
@@ -157,6 +195,149 @@ def pr_add_review():
         },
     )
     LOGGER.info("PullRequest Review Add Success, %s", pr.get_link("html"))
+    return pr.get_link("html")
 
 
-globals()[params["fun"]]()
+def delete_merged_branches(params):
+    """One delete_branch operation per source branch of a recently merged PR."""
+    repo_name = params["repo_name"]
+    url = f"{API_URL}2.0/repositories/{WORKSPACE}/{repo_name}"
+    since = (datetime.now(timezone.utc) - timedelta(days=MERGED_DAYS)).replace(
+        minute=0, second=0, microsecond=0
+    )
+
+    def sources(q):
+        pullrequests = _paginate(
+            f"{url}/pullrequests",
+            {"q": q, "fields": "next,values.source.branch.name", "pagelen": 50},
+        )
+        return {pr["source"]["branch"]["name"] for pr in pullrequests}
+
+    merged = sources(
+        all_of(compare("state", "=", "MERGED"), compare("updated_on", ">", since))
+    )
+    # a branch with another PR still open is kept
+    merged -= sources(compare("state", "=", "OPEN"))
+    branches = _paginate(
+        f"{url}/refs/branches", {"fields": "next,values.name", "pagelen": 100}
+    )
+    existing = {branch["name"] for branch in branches}
+    return [
+        {"fun": "delete_branch", "repo_name": repo_name, "source_branch": name}
+        for name in sorted(merged & existing)
+        if name not in PROTECTED_BRANCHES
+    ]
+
+
+ACTIONS = {
+    "release_pr": release_pr,
+    "hotfix_pr": hotfix_pr,
+    "merge_sandbox": merge_sandbox,
+    # the "new" menu sends this name, it merges develop
+    "merge_to_sandbox": merge_sandbox,
+    "develop_pr": develop_pr,
+    "delete_branch": delete_branch,
+    "merge_pr": merge_pr,
+    "decline_pr": decline_pr,
+    "pr_add_review": pr_add_review,
+}
+EXPANDERS = {
+    "delete_merged_branches": delete_merged_branches,
+}
+# branch each action merges or opens a pull request into
+DESTINATIONS = {
+    "release_pr": "master",
+    "hotfix_pr": "master",
+    "merge_sandbox": "sandbox",
+    "merge_to_sandbox": "sandbox",
+    "develop_pr": "develop",
+}
+# actions on a pull request, which carry its destination branch
+PR_WRITES = ("merge_pr", "decline_pr")
+
+
+def describe(op):
+    target = op.get("source_branch") or (f"#{op['pr_id']}" if "pr_id" in op else "")
+    return " ".join(filter(None, [op.get("fun", "?"), op.get("repo_name"), target]))
+
+
+def destination(op):
+    """Branch `op` writes into, None when it may run alongside anything."""
+    fun = op.get("fun")
+    if fun in PR_WRITES:
+        # a menu from before the destination was sent: all of the repo's pull requests
+        return op.get("destination_branch") or ""
+    return DESTINATIONS.get(fun)
+
+
+def run(op):
+    """Run one operation, return (op, ok, result or error message)."""
+    fun = op.get("fun")
+    try:
+        if fun not in ACTIONS and fun not in EXPANDERS:
+            raise ValueError(f"unknown operation {fun!r}")
+        if fun in EXPANDERS:
+            return op, True, EXPANDERS[fun](op)
+        return op, True, ACTIONS[fun](op)
+    except Exception as e:
+        LOGGER.exception("%s failed", describe(op))
+        return op, False, str(e) or type(e).__name__
+
+
+def lanes(ops):
+    """Split `ops` into lists that may run in parallel with each other.
+
+    Operations into the same destination of a repository share a list
+    and keep their order; any other operation gets a list of its own.
+    """
+    shared = {}
+    result = []
+    for op in ops:
+        branch = destination(op)
+        if branch is None:
+            result.append([op])
+            continue
+        key = (op.get("repo_name"), branch)
+        if key not in shared:
+            shared[key] = []
+            result.append(shared[key])
+        shared[key].append(op)
+    return result
+
+
+def run_lane(ops):
+    return [run(op) for op in ops]
+
+
+def run_all(executor, ops):
+    return [result for lane in executor.map(run_lane, lanes(ops)) for result in lane]
+
+
+def run_batch(ops):
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        expanded = []
+        results = []
+        for op, ok, result in run_all(executor, ops):
+            if ok and op.get("fun") in EXPANDERS:
+                LOGGER.info("%s: %d operations", describe(op), len(result))
+                expanded.extend(result)
+            else:
+                results.append((op, ok, result))
+        results.extend(run_all(executor, expanded))
+    return results
+
+
+params = decode_params()
+
+LOGGER.info(params)
+
+results = run_batch(params if isinstance(params, list) else [params])
+if any(ok and op.get("fun") in ACTIONS for op, ok, _ in results):
+    # the menus show the change on their next run, not a DATA_TTL later
+    expire_workspace(WORKSPACE)
+print()
+for op, ok, result in results:
+    print(f"{'OK' if ok else 'FAILED':6} {describe(op)}: {result}")
+failed = sum(1 for _, ok, _ in results if not ok)
+print(f"{len(results) - failed}/{len(results)} operations succeeded")
+sys.exit(1 if failed else 0)
@@ -0,0 +1,160 @@
+"""Builder and validator for Bitbucket `q=` filter expressions.
+
+Filters are pushed down to the API instead of dropping results client
+side. The builders quote values the way the query language expects;
+user supplied expressions (xbar vars) are checked by a small parser so
+a typo is reported in the menu instead of as an HTTP 400 on every
+refresh.
+
+https://developer.atlassian.com/cloud/bitbucket/rest/intro/#filtering
+"""
+import re
+from datetime import datetime
+
+OPERATORS = ("!=", ">=", "<=", "!~", "=", ">", "<", "~")
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<op>!=|>=|<=|!~|=|>|<|~)
+      | (?P<paren>[()])
+      | (?P<word>[^\s()"=!<>~]+)
+    )""",
+    re.VERBOSE,
+)
+FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+# dates and datetimes are written unquoted
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ][0-9:.]+)?(Z|[+-]\d{2}:?\d{2})?$")
+
+
+class QueryError(ValueError):
+    pass
+
+
+def value(v):
+    """Render a python value as a query literal."""
+    if v is None:
+        return "null"
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, (int, float)):
+        return str(v)
+    if isinstance(v, datetime):
+        return v.isoformat()
+    escaped = str(v).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def compare(field, op, v):
+    if op not in OPERATORS:
+        raise QueryError(f"unknown operator {op!r}")
+    if not FIELD.match(field):
+        raise QueryError(f"invalid field {field!r}")
+    return f"{field} {op} {value(v)}"
+
+
+def _join(keyword, expressions):
+    expressions = [e for e in expressions if e]
+    if len(expressions) <= 1:
+        return expressions[0] if expressions else None
+    return f" {keyword} ".join(f"({e})" for e in expressions)
+
+
+def all_of(*expressions):
+    """AND of the non-empty expressions, None when there are none."""
+    return _join("AND", expressions)
+
+
+def any_of(*expressions):
+    """OR of the non-empty expressions, None when there are none."""
+    return _join("OR", expressions)
+
+
+def none_of(field, values):
+    """`field` equals none of `values`."""
+    return all_of(*(compare(field, "!=", v) for v in values))
+
+
+def _tokens(expression):
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise QueryError(f"unexpected {expression[pos:].strip()[:10]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        yield kind, match.group(kind)
+
+
+class _Parser:
+    """query := term (OR term)*, term := factor (AND factor)*,
+    factor := "(" query ")" | field op literal"""
+
+    def __init__(self, expression):
+        self.tokens = list(_tokens(expression))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def keyword(self, word):
+        kind, text = self.peek()
+        if kind == "word" and text.upper() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("empty expression")
+        self.query()
+        if self.pos < len(self.tokens):
+            raise QueryError(f"unexpected {self.peek()[1]!r}")
+
+    def query(self):
+        self.term()
+        while self.keyword("OR"):
+            self.term()
+
+    def term(self):
+        self.factor()
+        while self.keyword("AND"):
+            self.factor()
+
+    def factor(self):
+        kind, text = self.take()
+        if kind == "paren" and text == "(":
+            self.query()
+            if self.take() != ("paren", ")"):
+                raise QueryError("missing ')'")
+            return
+        if kind != "word" or not FIELD.match(text):
+            raise QueryError(f"expected a field, got {text!r}")
+        kind, op = self.take()
+        if kind != "op":
+            raise QueryError(f"expected an operator after {text!r}")
+        kind, literal = self.take()
+        if kind == "string":
+            return
+        if kind == "word" and (
+            literal in ("true", "false", "null")
+            or NUMBER.match(literal)
+            or DATE.match(literal)
+        ):
+            return
+        raise QueryError(f"invalid value {literal!r} for {text!r}")
+
+
+def validate(expression):
+    """Return `expression` stripped, raise QueryError when it does not parse."""
+    expression = (expression or "").strip()
+    if expression:
+        _Parser(expression).parse()
+    return expression or None
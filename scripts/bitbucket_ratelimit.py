@@ -0,0 +1,122 @@
+"""Token bucket shared by every process that talks to the Bitbucket API.
+
+The plugins and bitbucket_ops.py run as separate processes against the
+same hourly quota. The bucket lives in one small JSON file under the
+state directory and is only read and written under an exclusive flock,
+so every process draws from the same budget.
+
+Background refreshes leave a reserve of tokens for interactive actions
+(merge, decline, ...) and back off entirely while the API asks for it:
+a 429 with Retry-After blocks them until then, X-RateLimit-NearLimit
+or a low X-RateLimit-Remaining drains the bucket down to the reserve.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from xbar_state import STATE_DIR
+
+LOGGER = logging.getLogger("bitbucket ratelimit")
+
+HOURLY_LIMIT = int(os.environ.get("VAR_RATE_LIMIT") or 1000)
+# kept for interactive requests, background ones stop above it
+RESERVE = max(1, HOURLY_LIMIT // 20)
+RETRY_AFTER = 60
+POLL = 0.25
+
+
+class RateLimited(Exception):
+    """No API budget came in time; the request was not sent."""
+
+
+class RateLimiter:
+    def __init__(self, path=STATE_DIR / "ratelimit.json", limit=HOURLY_LIMIT):
+        self.path = path
+        self.limit = limit
+
+    @contextmanager
+    def _state(self):
+        """Yield the bucket state, written back when the block exits."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                state = {"tokens": self.limit, "updated_at": time.time(), "blocked_until": 0}
+            self._refill(state)
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+
+    def _refill(self, state):
+        # the bucket holds one hour of quota and refills at the hourly rate
+        now = time.time()
+        limit = state.get("limit", self.limit)
+        elapsed = max(0, now - state["updated_at"])
+        state["tokens"] = min(limit, state["tokens"] + elapsed * limit / 3600)
+        state["updated_at"] = now
+
+    def _wait_time(self, state, interactive):
+        """Seconds until a token is available to this caller, 0 if one is now."""
+        floor = 0 if interactive else RESERVE
+        if not interactive and state["blocked_until"] > time.time():
+            return state["blocked_until"] - time.time()
+        if state["tokens"] >= floor + 1:
+            return 0
+        rate = state.get("limit", self.limit) / 3600
+        return (floor + 1 - state["tokens"]) / rate
+
+    def acquire(self, interactive=False, timeout=None):
+        """Take one token, waiting up to `timeout`; False when none came in time."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._state() as state:
+                wait = self._wait_time(state, interactive)
+                if wait == 0:
+                    state["tokens"] -= 1
+                    return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                LOGGER.warning("no API budget for %.0fs", wait)
+                return False
+            time.sleep(min(wait, POLL))
+
+    def throttled(self, interactive=False):
+        """True when a request of this priority would have to wait."""
+        with self._state() as state:
+            return self._wait_time(state, interactive) > 0
+
+    def update(self, response):
+        """Adapt the bucket to the rate limit headers of an API response."""
+        headers = response.headers
+        if response.status_code != 429 and not any(
+            key.lower().startswith("x-ratelimit") for key in headers
+        ):
+            return
+        with self._state() as state:
+            if headers.get("X-RateLimit-Limit", "").isdigit():
+                state["limit"] = int(headers["X-RateLimit-Limit"])
+            if headers.get("X-RateLimit-Remaining", "").isdigit():
+                state["tokens"] = min(state["tokens"], int(headers["X-RateLimit-Remaining"]))
+            if headers.get("X-RateLimit-NearLimit", "").lower() == "true":
+                state["tokens"] = min(state["tokens"], RESERVE)
+            if response.status_code == 429:
+                retry_after = headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else RETRY_AFTER
+                state["tokens"] = 0
+                state["blocked_until"] = time.time() + delay
+                LOGGER.warning("rate limited, background requests paused for %ds", delay)
+
+    def backoff(self):
+        """Factor to stretch polling intervals by while the quota is tight."""
+        with self._state() as state:
+            if state["blocked_until"] > time.time():
+                return 4
+            if state["tokens"] < RESERVE + 1:
+                return 2
+            return 1
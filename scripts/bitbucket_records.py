@@ -0,0 +1,196 @@
+"""Slim records of the Bitbucket objects the menus render.
+
+Each record keeps only the fields a menu shows, in `__slots__`, and
+knows the `fields=` projection that asks the API for exactly those, so
+neither the response nor the parsed objects carry the rest of the
+payload. Records are stored in the workspace snapshot as plain lists of
+their slot values.
+"""
+
+
+def _user_name(user):
+    if not user:
+        return None
+    return user.get("nickname") or user.get("display_name")
+
+
+def _status(state):
+    if "result" in state:
+        return state["result"]["name"]
+    return state["name"]
+
+
+def _fields(*paths):
+    """`fields=` value for a paged listing of records with these `paths`."""
+    return ",".join(["next", "size", "page", "pagelen"] + [f"values.{p}" for p in paths])
+
+
+class Record:
+    __slots__ = ()
+    # slots holding lists of other records
+    nested = {}
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+    def to_json(self):
+        return [
+            [record.to_json() for record in getattr(self, name)]
+            if name in self.nested
+            else getattr(self, name)
+            for name in self.__slots__
+        ]
+
+    @classmethod
+    def from_json(cls, values):
+        return cls(
+            *(
+                [cls.nested[name].from_json(v) for v in value]
+                if name in cls.nested
+                else value
+                for name, value in zip(cls.__slots__, values)
+            )
+        )
+
+
+class PullRequest(Record):
+    __slots__ = (
+        "id",
+        "title",
+        "author",
+        "reviewers",
+        "created_on",
+        "updated_on",
+        "source_branch",
+        "destination_branch",
+    )
+    FIELDS = _fields(
+        "id",
+        "title",
+        "author.nickname",
+        "author.display_name",
+        "reviewers.nickname",
+        "reviewers.display_name",
+        "created_on",
+        "updated_on",
+        "source.branch.name",
+        "destination.branch.name",
+    )
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(
+            data["id"],
+            data["title"],
+            _user_name(data.get("author")),
+            [_user_name(user) for user in data.get("reviewers", [])],
+            data["created_on"],
+            data["updated_on"],
+            data["source"]["branch"]["name"],
+            data["destination"]["branch"]["name"],
+        )
+
+
+class Branch(Record):
+    __slots__ = ("name", "author", "message")
+    FIELDS = _fields(
+        "name",
+        "target.message",
+        "target.author.user.nickname",
+        "target.author.user.display_name",
+    )
+
+    @classmethod
+    def from_api(cls, data):
+        target = data.get("target") or {}
+        return cls(
+            data["name"],
+            _user_name((target.get("author") or {}).get("user")),
+            target.get("message", ""),
+        )
+
+
+class Step(Record):
+    __slots__ = ("uuid", "name", "status", "running", "started_on", "duration_in_seconds")
+    FIELDS = _fields(
+        "uuid",
+        "name",
+        "state.name",
+        "state.result.name",
+        "started_on",
+        "duration_in_seconds",
+    )
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(
+            data["uuid"],
+            data.get("name"),
+            _status(data["state"]),
+            data["state"]["name"] == "IN_PROGRESS",
+            data.get("started_on"),
+            data.get("duration_in_seconds"),
+        )
+
+
+class Pipeline(Record):
+    __slots__ = (
+        "uuid",
+        "build_number",
+        "created_on",
+        "status",
+        "target_name",
+        "build_seconds_used",
+        "steps",
+    )
+    nested = {"steps": Step}
+    FIELDS = _fields(
+        "uuid",
+        "build_number",
+        "created_on",
+        "state.name",
+        "state.result.name",
+        "target.type",
+        "target.ref_name",
+        "target.source",
+        "build_seconds_used",
+    )
+
+    @classmethod
+    def from_api(cls, data):
+        target = data.get("target") or {}
+        target_name = "-"
+        if target.get("type") == "pipeline_ref_target":
+            target_name = target["ref_name"]
+        elif target.get("type") == "pipeline_pullrequest_target":
+            target_name = target["source"]
+        return cls(
+            data["uuid"],
+            data["build_number"],
+            data["created_on"],
+            _status(data["state"]),
+            target_name,
+            data.get("build_seconds_used"),
+            [],
+        )
+
+
+class RepoSummary(Record):
+    """A repository of the workspace listing, before its details are fetched."""
+
+    __slots__ = ("full_name", "name", "slug", "updated_on")
+    FIELDS = _fields("full_name", "name", "slug", "updated_on")
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(data["full_name"], data["name"], data["slug"], data["updated_on"])
+
+
+class Repo(Record):
+    __slots__ = ("name", "slug", "pullrequests", "branches", "branches_size", "pipelines")
+    nested = {"pullrequests": PullRequest, "branches": Branch, "pipelines": Pipeline}
@@ -0,0 +1,79 @@
+"""Incremental discovery of the recently updated repositories of a workspace.
+
+The newest `updated_on` seen (the watermark) and the active repository set
+are persisted between runs, so a refresh only lists repositories updated
+since the previous one and rebuilds the rest from the stored records.
+Each day window has its own state file, as every call prunes the stored
+set to its window.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+from bitbucket_data import parse_time
+from bitbucket_query import compare
+from bitbucket_records import RepoSummary
+from xbar_state import load_state, save_state
+
+# a full listing now and then picks up deleted and renamed repositories
+RESYNC_INTERVAL = 60 * 60
+# bumped when the stored records change, older state is listed again
+STATE_VERSION = 2
+# the largest pagelen bitbucket accepts on the repository listing
+PAGELEN = 100
+
+
+def _state_name(workspace, days):
+    return f"repos-{workspace}-{days:g}d.json"
+
+
+def discover_repositories(fetcher, workspace, days=7):
+    """Return the RepoSummary of the repositories updated in the last `days`, newest first."""
+    name = _state_name(workspace, days)
+    state = load_state(name) or {}
+    if state.get("version") != STATE_VERSION:
+        state = {"version": STATE_VERSION}
+    known = {
+        full_name: RepoSummary.from_json(values)
+        for full_name, values in state.get("repos", {}).items()
+    }
+    window = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    watermark = state.get("watermark")
+
+    if watermark is None or time.time() - state.get("synced_at", 0) > RESYNC_INTERVAL:
+        known, since = {}, window
+        state["synced_at"] = time.time()
+    else:
+        since = max(watermark, window)
+
+    params = {
+        "q": compare("updated_on", ">", datetime.fromisoformat(since)),
+        "sort": "-updated_on",
+        "fields": RepoSummary.FIELDS,
+        "pagelen": PAGELEN,
+    }
+    for page in fetcher.paginate(fetcher.base, params):
+        for data in page["values"]:
+            known[data["full_name"]] = RepoSummary.from_api(data)
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    repos = [repo for repo in known.values() if parse_time(repo.updated_on) >= cutoff]
+    repos.sort(key=lambda repo: parse_time(repo.updated_on), reverse=True)
+
+    state["repos"] = {repo.full_name: repo.to_json() for repo in repos}
+    if repos:
+        state["watermark"] = repos[0].updated_on
+    else:
+        state["watermark"] = watermark or window
+    save_state(name, state)
+    return repos
+
+
+def forget_repositories(workspace, days, full_names):
+    """Drop repositories the API no longer serves (404/403) before the next resync."""
+    name = _state_name(workspace, days)
+    state = load_state(name)
+    if not state or state.get("version") != STATE_VERSION:
+        return
+    for full_name in full_names:
+        state["repos"].pop(full_name, None)
+    save_state(name, state)
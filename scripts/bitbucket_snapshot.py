@@ -0,0 +1,219 @@
+"""Rendered menu snapshots shared between a plugin and its background refresh.
+
+Only stdlib is imported here: a plugin checks for a snapshot before it
+pays for atlassian/requests, and prints it in milliseconds when one is
+available. Snapshots come either from the long running daemon
+(VAR_DAEMON) or, stale-while-revalidate style (VAR_SNAPSHOT), from a
+detached one-shot refresh started by the previous tick.
+
+The daemon reads the settings once, when it starts. Its pid file also
+holds a digest of the VAR_* settings it was started with, and a plugin
+run with other settings (or with VAR_DAEMON off) stops it, so changed
+preferences take effect on the next tick.
+
+usage: bitbucket_snapshot.py <name> <plugin path>   (one-shot refresh)
+"""
+import fcntl
+import hashlib
+import io
+import os
+import signal
+import sys
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from xbar_state import STATE_DIR, load_state, save_state
+
+DAEMON = os.environ.get("VAR_DAEMON", "false").lower() == "true"
+SNAPSHOT = os.environ.get("VAR_SNAPSHOT", "false").lower() == "true"
+DAEMON_INTERVAL = float(os.environ.get("VAR_DAEMON_INTERVAL") or 60)
+# an older snapshot is not trusted, the plugin renders inline instead
+MAX_AGE = DAEMON_INTERVAL * 5
+# set while a plugin runs on behalf of the daemon, skips the snapshot path
+RENDER_ENV = "XBAR_SNAPSHOT_RENDER"
+
+DAEMON_SCRIPT = Path(__file__).parent / "bitbucket_daemon.py"
+
+
+class Snapshot:
+    def __init__(self, text, created_at):
+        self.text = text
+        self.created_at = created_at
+
+    @property
+    def age(self):
+        return time.time() - self.created_at
+
+
+def read_snapshot(name):
+    data = load_state(f"snapshot-{name}.json")
+    if data is None:
+        return None
+    return Snapshot(data["text"], data["created_at"])
+
+
+def write_snapshot(name, text):
+    save_state(f"snapshot-{name}.json", {"text": text, "created_at": time.time()})
+
+
+def print_snapshot(snapshot):
+    sys.stdout.write(snapshot.text)
+    print("---")
+    print(f"Updated {int(snapshot.age)}s ago | size=11")
+
+
+def render(plugin_path):
+    """Run a plugin in this process and return what it printed."""
+    import runpy
+
+    os.environ[RENDER_ENV] = "1"
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        try:
+            runpy.run_path(plugin_path, run_name="__main__")
+        except SystemExit:
+            pass
+    return buffer.getvalue()
+
+
+def pid_path(name):
+    return STATE_DIR / f"daemon-{name}.pid"
+
+
+def settings_digest():
+    """Digest of the plugin settings, as xbar passes them in the environment."""
+    settings = sorted((k, v) for k, v in os.environ.items() if k.startswith("VAR_"))
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()[:12]
+
+
+def acquire_lock(path, content=None):
+    """Hold an exclusive lock on `path` while the file stays open, None if held."""
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    f = path.open("a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    f.seek(0)
+    f.truncate()
+    f.write(content or str(os.getpid()))
+    f.flush()
+    return f
+
+
+def lock_daemon(name, timeout=0):
+    """Take the daemon lock, waiting up to `timeout` for a stopped daemon to exit."""
+    deadline = time.monotonic() + timeout
+    while True:
+        lock = acquire_lock(pid_path(name), f"{os.getpid()} {settings_digest()}")
+        if lock is not None or time.monotonic() >= deadline:
+            return lock
+        time.sleep(0.1)
+
+
+def daemon_settings(name):
+    """(pid, settings digest) of the daemon that last held the lock, None for unknown."""
+    try:
+        fields = pid_path(name).read_text().split()
+        return int(fields[0]), (fields[1] if len(fields) > 1 else None)
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+def stop_daemon(name):
+    pid, _ = daemon_settings(name)
+    if pid is None:
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def daemon_alive(name):
+    try:
+        with pid_path(name).open() as f:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # the daemon holds the exclusive lock
+        return True
+    return False
+
+
+def spawn(script, name, plugin_path):
+    # imported here, it is not needed on the plain snapshot path
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, script.as_posix(), name, Path(plugin_path).as_posix()],
+        cwd=Path(plugin_path).parent,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def ensure_daemon(name, plugin_path):
+    if daemon_alive(name):
+        if daemon_settings(name)[1] == settings_digest():
+            return
+        # started with other settings; the new daemon waits for the lock
+        stop_daemon(name)
+    spawn(DAEMON_SCRIPT, name, plugin_path)
+
+
+def refresh(name, plugin_path):
+    """Render once and store the snapshot, unless another refresh is running."""
+    lock = acquire_lock(STATE_DIR / f"refresh-{name}.lock")
+    if lock is None:
+        return
+    with lock:
+        write_snapshot(name, render(plugin_path))
+
+
+def serve_from_daemon(name, plugin_path):
+    ensure_daemon(name, plugin_path)
+    # lets the daemon know a client is still around
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    (STATE_DIR / f"daemon-{name}.seen").touch()
+    snapshot = read_snapshot(name)
+    if snapshot is None or snapshot.age > MAX_AGE:
+        return False
+    print_snapshot(snapshot)
+    return True
+
+
+def serve_stale(name, plugin_path):
+    snapshot = read_snapshot(name)
+    if snapshot is None:
+        # first run, render inline and keep the result for the next tick
+        text = render(plugin_path)
+        write_snapshot(name, text)
+        sys.stdout.write(text)
+        return True
+    print_snapshot(snapshot)
+    spawn(Path(__file__), name, plugin_path)
+    return True
+
+
+def serve_snapshot(name, plugin_path):
+    """Print a snapshot for the plugin, True when the plugin has nothing left to do."""
+    if os.environ.get(RENDER_ENV):
+        return False
+    if DAEMON:
+        return serve_from_daemon(name, plugin_path)
+    if daemon_alive(name):
+        # VAR_DAEMON was turned off
+        stop_daemon(name)
+    if SNAPSHOT:
+        return serve_stale(name, plugin_path)
+    return False
+
+
+if __name__ == "__main__":
+    refresh(sys.argv[1], sys.argv[2])
@@ -0,0 +1,156 @@
+"""Timing trace of one plugin refresh.
+
+Every response of the shared session is recorded by a requests response
+hook (endpoint, status, latency, bytes, cache hit/miss) and the plugins
+wrap their phases in `span()`. The trace is written as a Chrome trace
+(one event per line, loadable in chrome://tracing or Perfetto) and the
+slowest calls are shown in a hidden Diagnostics submenu.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+LOGGER = logging.getLogger("bitbucket trace")
+
+TRACE_DIR = Path("./logs")
+SLOWEST = int(os.environ.get("VAR_DIAGNOSTICS_TOP") or 10)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        # small stable thread ids read better in the trace viewer
+        ident = threading.get_ident()
+        with self._lock:
+            return self._threads.setdefault(ident, len(self._threads))
+
+    def add(self, name, cat, start, duration, **args):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round((start - self.started) * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": self._tid(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, "phase", start, time.monotonic() - start)
+
+    def record_response(self, response, started, duration, size):
+        request = response.request
+        url = urlsplit(response.url or request.url)
+        self.add(
+            unquote(url.path),
+            "http",
+            started,
+            duration,
+            method=request.method,
+            status=response.status_code,
+            bytes=size,
+            cache=cache_status(response),
+            query=url.query,
+        )
+
+    def calls(self):
+        return [e for e in self.events if e["cat"] == "http"]
+
+    def phases(self):
+        return [e for e in self.events if e["cat"] == "phase"]
+
+    def slowest(self, top=SLOWEST):
+        return sorted(self.calls(), key=lambda e: e["dur"], reverse=True)[:top]
+
+    def write(self, directory=TRACE_DIR):
+        """Replace the trace of the previous refresh with this one."""
+        path = directory / f"{self.name}-trace.json"
+        events = sorted(self.events, key=lambda e: e["ts"])
+        try:
+            with path.open("w", encoding="utf-8") as f:
+                f.write('{"traceEvents":[\n')
+                f.write(",\n".join(json.dumps(e, separators=(",", ":")) for e in events))
+                f.write("\n]}\n")
+        except OSError:
+            LOGGER.warning("trace write failed: %s", path, exc_info=True)
+
+
+def cache_status(response):
+    if getattr(response, "revalidated", False):
+        return "revalidated"
+    if getattr(response, "from_cache", False):
+        return "hit"
+    return "miss"
+
+
+_current = Trace("default")
+
+
+def start_trace(name):
+    """Start a new trace; the session hook records into the latest one."""
+    global _current
+    _current = Trace(name)
+    return _current
+
+
+def span(name):
+    """Time a phase of the current trace."""
+    return _current.span(name)
+
+
+def response_hook(response, *args, **kwargs):
+    """requests response hook, installed on the shared session."""
+    start = time.monotonic()
+    if kwargs.get("stream"):
+        # the body is still on the wire, its length is all we know
+        size = int(response.headers.get("Content-Length") or 0)
+    else:
+        # read here rather than right after the hook so it counts as latency
+        size = len(response.content)
+    finished = time.monotonic()
+    duration = response.elapsed.total_seconds() + finished - start
+    _current.record_response(response, finished - duration, duration, size)
+    return response
+
+
+def _format_call(event):
+    args = event["args"]
+    return (
+        f"{event['dur'] / 1000:7.0f}ms {args['status']} {args['cache']:<5}"
+        f" {args['bytes'] / 1024:6.1f}KiB {event['name']}"
+    )
+
+
+def add_diagnostics(parent, trace, top=SLOWEST):
+    """Fill a menu item with the phases and the slowest calls of `trace`."""
+    calls = trace.calls()
+    cached = sum(1 for e in calls if e["args"]["cache"] != "miss")
+    total = sum(e["args"]["bytes"] for e in calls)
+    elapsed = (time.monotonic() - trace.started) * 1000
+    parent.add(
+        f"{elapsed:.0f}ms, {len(calls)} calls, {cached} cached, {total / 1024:.0f}KiB"
+    )
+    for event in trace.phases():
+        parent.add(f"{event['name']}: {event['dur'] / 1000:.0f}ms")
+    parent.separator()
+    for event in trace.slowest(top):
+        parent.add(_format_call(event), font="Menlo", size=11)
@@ -0,0 +1,90 @@
+#! /usr/local/bin/python3
+"""Cold start report for the python plugins, based on `python -X importtime`.
+
+usage: importtime_report.py [--budget-ms 150] [--top 10]
+
+Each plugin is started without credentials, i.e. on its "Setup VAR" path,
+which must stay cheap because xbar pays it on every tick. The full import
+set of a refresh is reported for reference. The exit status is 1 when a
+plugin's startup goes over the budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).parent.parent
+PLUGINS = ["pr.1m.py", "pipeline.1m.py"]
+# everything a real refresh imports
+FULL_IMPORTS = "import bitbucket_data, bitbucket_http, bitbucket_repos"
+
+
+def parse_importtime(stderr):
+    """Return [(cumulative_us, module)] of the top level imports."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # nested imports are indented below their parent
+        if not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return imports
+
+
+def measure(args, cwd):
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ("VAR_USERNAME", "VAR_PASSWORD", "VAR_WORKSPACE")
+    }
+    env["PYTHONPATH"] = (PLUGIN_DIR / "scripts").as_posix()
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    started = time.monotonic()
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall_ms = (time.monotonic() - started) * 1000
+    return wall_ms, parse_importtime(res.stderr)
+
+
+def report(title, wall_ms, imports, top):
+    total_ms = sum(us for us, _ in imports) / 1000
+    print(f"{title}: wall {wall_ms:.0f}ms, imports {total_ms:.0f}ms")
+    for us, name in sorted(imports, reverse=True)[:top]:
+        print(f"    {us / 1000:8.1f}ms  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--budget-ms", type=float, default=150)
+    parser.add_argument("--top", type=int, default=10)
+    options = parser.parse_args()
+
+    over_budget = []
+    with tempfile.TemporaryDirectory() as cwd:
+        # the plugins log to ./logs
+        (Path(cwd) / "logs").mkdir()
+        for plugin in PLUGINS:
+            wall_ms, imports = measure([(PLUGIN_DIR / plugin).as_posix()], cwd)
+            report(plugin, wall_ms, imports, options.top)
+            if wall_ms > options.budget_ms:
+                over_budget.append(plugin)
+        wall_ms, imports = measure(["-c", FULL_IMPORTS], cwd)
+        report("refresh imports", wall_ms, imports, options.top)
+
+    if over_budget:
+        print(f"over the {options.budget_ms:.0f}ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Summaries of one or more pi-hole instances, polled in parallel.
+
+Each instance is one collect() task over a shared pooled session, so a
+slow or unreachable instance only costs its own deadline and is marked
+as such, while the others are merged into aggregate totals.
+"""
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# counters added up across instances
+SUMMED = (
+    "ads_blocked_today",
+    "dns_queries_today",
+    "queries_cached",
+    "queries_forwarded",
+    "unique_domains",
+)
+
+
+def parse_urls(value):
+    """Admin URLs from a comma separated setting, without trailing slashes."""
+    return [url.strip().rstrip("/") for url in (value or "").split(",") if url.strip()]
+
+
+def make_session(size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def summary_task(session, url, timeout):
+    """collect() task fetching the summary of the instance at `url`."""
+
+    def get_summary():
+        started = time.monotonic()
+        response = session.get(f"{url}/api.php?summary", timeout=timeout)
+        response.raise_for_status()
+        return response.json(), time.monotonic() - started
+
+    return get_summary
+
+
+def _number(value):
+    return float(str(value).replace(",", ""))
+
+
+class Instance:
+    __slots__ = ("url", "summary", "seconds", "error")
+
+    def __init__(self, url, summary=None, seconds=None, error=None):
+        self.url = url
+        self.summary = summary
+        self.seconds = seconds
+        self.error = error
+
+    @classmethod
+    def from_result(cls, url, result):
+        """From the collect() result of its summary_task."""
+        if isinstance(result, Exception):
+            return cls(url, error=str(result) or type(result).__name__)
+        summary, seconds = result
+        return cls(url, summary, seconds)
+
+    @property
+    def name(self):
+        return urlsplit(self.url).netloc or self.url
+
+    @property
+    def reachable(self):
+        return self.summary is not None
+
+    def slow(self, threshold):
+        return self.reachable and self.seconds > threshold
+
+
+def aggregate(instances):
+    """One summary of the reachable instances, None when none is.
+
+    Counters are added up; the blocklists are usually shared between
+    instances, so the domain count is the largest one.
+    """
+    summaries = [i.summary for i in instances if i.reachable]
+    if not summaries:
+        return None
+    if len(summaries) == 1:
+        return summaries[0]
+    totals = {key: sum(_number(s[key]) for s in summaries) for key in SUMMED}
+    blocked = max(_number(s["domains_being_blocked"]) for s in summaries)
+    percentage = totals["ads_blocked_today"] * 100 / (totals["dns_queries_today"] or 1)
+    result = {key: f"{int(value):,}" for key, value in totals.items()}
+    result["domains_being_blocked"] = f"{int(blocked):,}"
+    result["ads_percentage_today"] = f"{percentage:.1f}"
+    return result
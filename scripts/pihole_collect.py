@@ -0,0 +1,51 @@
+"""Concurrent data collection for the pi-hole plugin.
+
+A refresh needs the network probe, the pi-hole summary and the DNS
+lookups. They run at the same time, each in a daemon thread with its own
+deadline, so a hung pi-hole or resolver costs at most that deadline and
+cannot keep the process alive once the menu is written.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+def _start(fn):
+    """Run `fn` in a daemon thread; a thread pool would be joined at exit."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=getattr(fn, "__name__", None), daemon=True).start()
+    return future
+
+
+def collect(tasks):
+    """Run `tasks`, {name: (fn, timeout)}, concurrently.
+
+    Returns {name: result}, where the result of a task that failed or
+    missed its deadline is the exception.
+    """
+    started = time.monotonic()
+    futures = {name: (_start(fn), timeout) for name, (fn, timeout) in tasks.items()}
+    results = {}
+    for name, (future, timeout) in futures.items():
+        try:
+            results[name] = future.result(max(0, started + timeout - time.monotonic()))
+        except FutureTimeout:
+            results[name] = TaskTimeout(f"{name} timed out after {timeout}s")
+        except Exception as e:
+            results[name] = e
+    return results
+
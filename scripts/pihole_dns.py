@@ -0,0 +1,59 @@
+"""Keep the system DNS servers at the addresses of the pi-hole host.
+
+The reconciler persists the server set it resolved, when it last
+checked, and the set it last applied. Between checks (every `ttl`
+seconds, failed ones included) a refresh costs nothing: no lookup, no
+`networksetup` call. When a check is due the plugin resolves the host
+and reads the system servers, and the setter is only called when the
+two sets really differ.
+"""
+import time
+
+from xbar_state import load_state, save_state
+
+
+class DnsReconciler:
+    def __init__(self, name, ttl, setter):
+        self.name = name
+        self.ttl = ttl
+        # called with the sorted server list, replaced in tests
+        self.setter = setter
+        self.state = load_state(name) or {}
+
+    @property
+    def servers(self):
+        """The resolved server set, None before the first resolution."""
+        return self.state.get("servers")
+
+    @property
+    def applied_at(self):
+        return self.state.get("applied_at")
+
+    def due(self, now=None):
+        now = now or time.time()
+        return (
+            self.state.get("ttl") != self.ttl
+            or now - self.state.get("checked_at", 0) >= self.ttl
+        )
+
+    def update(self, resolved=None, system=None, checked=False, now=None):
+        """Reconcile with the lookups of a check, None for a failed one.
+
+        `checked` is True when this run made the due check. Returns True
+        when the setter was called.
+        """
+        now = now or time.time()
+        if checked:
+            self.state.update(checked_at=now, ttl=self.ttl)
+        if resolved is not None:
+            self.state.update(servers=sorted(set(resolved)), resolved_at=now)
+        if system is not None:
+            self.state["applied"] = sorted(set(system))
+        applied = False
+        if self.servers and self.servers != self.state.get("applied"):
+            self.setter(self.servers)
+            self.state.update(applied=self.servers, applied_at=now)
+            applied = True
+        if checked or applied:
+            save_state(self.name, self.state)
+        return applied
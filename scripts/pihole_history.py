@@ -0,0 +1,162 @@
+"""Time series of the pi-hole summary counters in a fixed-size ring file.
+
+Every refresh appends one sample, a timestamp and the counters in
+`FIELDS`, as a fixed-width record. The file holds the newest `capacity`
+samples and never grows: once full, each append overwrites the oldest
+record in place. Rates, deltas and sparklines are computed from the
+samples, so history costs no extra API calls.
+
+With several pi-hole instances each one has its own file, all sampled
+at the same timestamps; merged_deltas() adds their increases up, so an
+instance that is down only leaves gaps instead of stopping the history.
+"""
+import fcntl
+import os
+import struct
+from contextlib import contextmanager
+
+FIELDS = ("queries", "blocked", "cached", "forwarded", "unique_domains")
+# api.php?summary key of each field
+SUMMARY_KEYS = (
+    "dns_queries_today",
+    "ads_blocked_today",
+    "queries_cached",
+    "queries_forwarded",
+    "unique_domains",
+)
+MAGIC = b"PHT1"
+# magic, capacity, count, index of the next record
+HEADER = struct.Struct("<4sIII")
+RECORD = struct.Struct("<d%dq" % len(FIELDS))
+BARS = "▁▂▃▄▅▆▇█"
+
+
+def sample_values(summary):
+    """Counter values of an api.php?summary response, which formats them as "1,234"."""
+    return tuple(int(str(summary[key]).replace(",", "")) for key in SUMMARY_KEYS)
+
+
+class History:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = max(2, int(capacity))
+
+    @contextmanager
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+
+    def _header(self, f):
+        f.seek(0)
+        data = f.read(HEADER.size)
+        if len(data) == HEADER.size:
+            magic, capacity, count, head = HEADER.unpack(data)
+            if magic == MAGIC:
+                return capacity, count, head
+        return None
+
+    def _read(self, f, header):
+        capacity, count, head = header
+        f.seek(HEADER.size)
+        data = f.read(capacity * RECORD.size)
+        data = data[: len(data) - len(data) % RECORD.size]
+        records = [(values[0], values[1:]) for values in RECORD.iter_unpack(data)]
+        # oldest first: the ring starts at `head` once it has wrapped
+        start = head if count == capacity else 0
+        return (records[start:] + records[:start])[:count]
+
+    def _rewrite(self, f, samples):
+        samples = samples[-self.capacity :]
+        f.seek(0)
+        f.truncate()
+        f.write(HEADER.pack(MAGIC, self.capacity, len(samples), len(samples) % self.capacity))
+        for when, values in samples:
+            f.write(RECORD.pack(when, *values))
+        # preallocate, the file keeps its size from now on
+        f.truncate(HEADER.size + self.capacity * RECORD.size)
+
+    def append(self, when, values):
+        with self._open() as f:
+            header = self._header(f)
+            if header is None or header[0] != self.capacity:
+                # new file, or the size setting changed: keep the newest samples
+                samples = self._read(f, header) if header else []
+                self._rewrite(f, samples + [(when, tuple(values))])
+                return
+            capacity, count, head = header
+            f.seek(HEADER.size + head * RECORD.size)
+            f.write(RECORD.pack(when, *values))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, capacity, min(count + 1, capacity), (head + 1) % capacity))
+
+    def samples(self):
+        """(timestamp, values) pairs, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        with self._open() as f:
+            header = self._header(f)
+            return self._read(f, header) if header else []
+
+
+def deltas(samples, field):
+    """(seconds, increase) of `field` between consecutive samples.
+
+    The counters restart at midnight; a drop counts the new value as the increase.
+    """
+    i = FIELDS.index(field)
+    result = []
+    for (t0, v0), (t1, v1) in zip(samples, samples[1:]):
+        if t1 > t0:
+            increase = v1[i] - v0[i]
+            result.append((t1 - t0, v1[i] if increase < 0 else increase))
+    return result
+
+
+def rates(samples, field):
+    """Per minute rates of `field` between consecutive samples."""
+    return [increase * 60 / seconds for seconds, increase in deltas(samples, field)]
+
+
+def merged_deltas(series, field):
+    """(seconds, increase) of `field` added up over the samples of several instances.
+
+    `series` holds the samples of each instance. Intervals run between
+    consecutive timestamps of any instance; one where an instance has a
+    sample at one end only, i.e. it went down or came back, is a gap: None.
+    An instance without any sample in the interval is left out.
+    """
+    i = FIELDS.index(field)
+    by_time = [dict(samples) for samples in series]
+    times = sorted(set().union(*by_time))
+    result = []
+    for t0, t1 in zip(times, times[1:]):
+        total = 0
+        gap = False
+        for values in by_time:
+            if t0 in values and t1 in values:
+                increase = values[t1][i] - values[t0][i]
+                total += values[t1][i] if increase < 0 else increase
+            elif t0 in values or t1 in values:
+                gap = True
+        result.append(None if gap else (t1 - t0, total))
+    return result
+
+
+def sparkline(values):
+    """Bars of `values`; None, a gap, is drawn as a dot."""
+    known = [v for v in values if v is not None]
+    if not known:
+        return ""
+    low, high = min(known), max(known)
+
+    def bar(v):
+        if v is None:
+            return "·"
+        if high == low:
+            return BARS[0]
+        return BARS[round((v - low) / (high - low) * (len(BARS) - 1))]
+
+    return "".join(bar(v) for v in values)
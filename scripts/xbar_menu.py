@@ -0,0 +1,117 @@
+"""In-memory xbar document builder shared by the plugins.
+
+The menu is assembled as a tree of `Item`s and written with a single
+buffered write once rendering is done, instead of one print per line
+interleaved with network calls.
+"""
+import json
+import sys
+from base64 import b64encode
+
+SEPARATOR = "---"
+
+
+def _freeze(value):
+    """Hashable stand-in for a JSON value; key order is kept, as json.dumps keeps it.
+
+    Scalars carry their type: True, 1 and 1.0 are equal keys but encode
+    differently.
+    """
+    if isinstance(value, dict):
+        return dict, tuple((_freeze(key), _freeze(v)) for key, v in value.items())
+    if isinstance(value, list):
+        return list, tuple(_freeze(v) for v in value)
+    return type(value), value
+
+
+_ENCODED = {}
+ENCODED_SIZE = 1024
+
+
+def encode_params(params):
+    """base64 JSON of shell params, a dict or a list of them.
+
+    Memoized on the params themselves, so a repeated action (the same
+    menu on every tick of the daemon) skips the serialization too.
+    """
+    key = _freeze(params)
+    encoded = _ENCODED.get(key)
+    if encoded is None:
+        encoded = b64encode(json.dumps(params).encode("utf-8")).decode("utf-8")
+        if len(_ENCODED) >= ENCODED_SIZE:
+            _ENCODED.clear()
+        _ENCODED[key] = encoded
+    return encoded
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    value = str(value)
+    if " " in value and not value.startswith('"'):
+        return f'"{value}"'
+    return value
+
+
+class Item:
+    __slots__ = ("title", "params", "children")
+
+    def __init__(self, title, **params):
+        self.title = title
+        self.params = params
+        self.children = []
+
+    def add(self, title, **params):
+        """Append a child item and return it."""
+        item = Item(title, **params)
+        self.children.append(item)
+        return item
+
+    def separator(self):
+        """Append a separator; like any item it can take children."""
+        return self.add(SEPARATOR)
+
+    def line(self):
+        if self.title == SEPARATOR:
+            return SEPARATOR
+        # a pipe in the title would start the params
+        title = str(self.title).replace("|", "｜")
+        if not self.params:
+            return title
+        params = " ".join(
+            f"{key}={_format_value(value)}"
+            for key, value in self.params.items()
+            if value is not None
+        )
+        if not title:
+            return f"| {params}"
+        return f"{title} | {params}"
+
+    def lines(self, depth=0):
+        prefix = "--" * depth
+        yield prefix + self.line()
+        for child in self.children:
+            yield from child.lines(depth + 1)
+
+
+class Menu:
+    def __init__(self):
+        self.items = []
+
+    def add(self, title, **params):
+        item = Item(title, **params)
+        self.items.append(item)
+        return item
+
+    def separator(self):
+        return self.add(SEPARATOR)
+
+    def render(self):
+        return "".join(
+            line + "\n" for item in self.items for line in item.lines()
+        )
+
+    def write(self, stream=None):
+        stream = stream or sys.stdout
+        stream.write(self.render())
+        stream.flush()
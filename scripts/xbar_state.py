@@ -0,0 +1,34 @@
+"""Small JSON state files shared between plugin runs, used by every plugin."""
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+LOGGER = logging.getLogger("xbar state")
+
+STATE_DIR = Path(os.environ.get("XBAR_CACHE_DIR") or Path(__file__).parent.parent / "cache")
+
+
+def load_state(name, default=None):
+    try:
+        with (STATE_DIR / name).open(encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_state(name, data):
+    """Write atomically so a concurrent reader never sees half a file."""
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=STATE_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, STATE_DIR / name)
+    except OSError:
+        LOGGER.warning("state write failed: %s", name, exc_info=True)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass